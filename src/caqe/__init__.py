@@ -8,6 +8,7 @@ from flask.ext.sqlalchemy import SQLAlchemy
 from werkzeug.contrib.fixers import ProxyFix
 
 import caqe.configuration as configuration
+from caqe.sessions import create_session_interface
 
 __version__ = '0.1.1a1'
 __title__ = 'CAQE'
@@ -43,6 +44,10 @@ elif configuration.APP_MODE == 'EVALUATION':
 Bootstrap(app)
 db = SQLAlchemy(app)
 
+session_interface = create_session_interface(app.config)
+if session_interface is not None:
+    app.session_interface = session_interface
+
 # MAKE SURE TO CREATE THE DATABASE - E.G. db.create_all()
 
 
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Running rating statistics of conditions, used to allocate trials to the conditions that need them most (see
+`CONDITION_ALLOCATION_POLICY`) and to stop collecting trials of conditions early (see `EARLY_STOPPING_ENABLED`)
+"""
+import math
+
+
+def update_rating_statistics(statistics, ratings):
+    """
+    Add the ratings of a trial to the running statistics of a condition, using Welford's online algorithm.
+
+    Parameters
+    ----------
+    statistics : dict
+        Map from stimulus key to [count, mean, sum of squared differences from the mean]. Updated in place.
+    ratings : dict
+        Map from stimulus key to rating, as submitted in the trial data. Ratings that are not numbers are ignored.
+
+    Returns
+    -------
+    statistics : dict
+    """
+    for stimulus_key, rating in ratings.items():
+        try:
+            rating = float(rating)
+        except (TypeError, ValueError):
+            continue
+        n, mean, m2 = statistics.get(stimulus_key, (0, 0., 0.))
+        n += 1
+        delta = rating - mean
+        mean += delta / n
+        m2 += delta * (rating - mean)
+        statistics[stimulus_key] = [n, mean, m2]
+    return statistics
+
+
+def confidence_interval_half_width(n, m2, z):
+    """
+    The half-width of the normal-approximation confidence interval of a mean.
+
+    Parameters
+    ----------
+    n : int
+        Number of ratings
+    m2 : float
+        Sum of squared differences from the mean
+    z : float
+        The standard score of the confidence level, e.g. 1.96 for 95%
+
+    Returns
+    -------
+    float
+        None if there are fewer than two ratings
+    """
+    if n < 2:
+        return None
+    return z * math.sqrt(m2 / (n - 1) / n)
+
+
+def condition_confidence_interval_half_width(statistics, z):
+    """
+    The widest confidence interval half-width of the mean ratings of a condition's stimuli.
+
+    Parameters
+    ----------
+    statistics : dict
+        See `update_rating_statistics`
+    z : float
+
+    Returns
+    -------
+    float
+        None if any stimulus has fewer than two ratings, or there are no ratings
+    """
+    widths = [confidence_interval_half_width(n, m2, z) for n, _, m2 in statistics.values()]
+    if len(widths) == 0 or None in widths:
+        return None
+    return max(widths)
+
+
+def allocation_weights(widths):
+    """
+    Weights for sampling conditions in proportion to their confidence interval widths. Conditions without a width yet
+    get the widest known width, so that they are sampled at least as often as any other.
+
+    Parameters
+    ----------
+    widths : list of float
+        Confidence interval half-widths, None where unknown
+
+    Returns
+    -------
+    weights : list of float
+    """
+    known = [w for w in widths if w is not None]
+    unknown_weight = max(known) if len(known) > 0 and max(known) > 0 else 1.
+    return [unknown_weight if w is None else max(w, 1e-6 * unknown_weight) for w in widths]
+
+
+def group_allocation_weights(groups):
+    """
+    Weights for sampling groups of conditions in proportion to the sum of the `allocation_weights` of their conditions,
+    computed from aggregates of the widths of each group (so that the widths of the individual conditions need not be
+    loaded). The lower bound on the weight of a condition is applied to the sum of the known widths of a group.
+
+    Parameters
+    ----------
+    groups : list of tuple
+        (number of conditions, number of conditions with a known width, sum of the known widths, maximum known width) of
+        each group. The sum and maximum are None if no width is known.
+
+    Returns
+    -------
+    weights : list of float
+    """
+    known = [max_width for _, known_count, _, max_width in groups if known_count > 0]
+    unknown_weight = max(known) if len(known) > 0 and max(known) > 0 else 1.
+    return [(count - known_count) * unknown_weight + max(width_sum or 0., known_count * 1e-6 * unknown_weight)
+            for count, known_count, width_sum, _ in groups]
+
+
+def wilson_interval(n, p, z):
+    """
+    The Wilson score confidence interval of a binomial proportion.
+
+    Parameters
+    ----------
+    n : int
+        Number of observations
+    p : float
+        Observed proportion
+    z : float
+
+    Returns
+    -------
+    (float, float)
+        The lower and upper bounds of the interval
+    """
+    denominator = 1. + z ** 2 / n
+    center = (p + z ** 2 / (2. * n)) / denominator
+    half_width = z * math.sqrt(p * (1. - p) / n + z ** 2 / (4. * n ** 2)) / denominator
+    return center - half_width, center + half_width
+
+
+def meets_stopping_rule(statistics, test_type, min_trials, max_ci_half_width, z):
+    """
+    Check whether a condition has enough ratings to stop collecting trials of it.
+
+    * For 'mushra', the confidence intervals of the mean ratings of all stimuli must be at most `max_ci_half_width`
+      wide (on each side).
+    * For 'pairwise', the ratings are 1 for the preferred stimulus and 0 otherwise, so the mean rating of a stimulus is
+      its win probability. The preference is decided when the Wilson confidence interval of every stimulus' win
+      probability excludes 0.5.
+
+    Other test types are never stopped early.
+
+    Parameters
+    ----------
+    statistics : dict
+        See `update_rating_statistics`
+    test_type : str
+    min_trials : int
+        Minimum number of ratings of every stimulus
+    max_ci_half_width : float
+    z : float
+
+    Returns
+    -------
+    bool
+    """
+    if len(statistics) == 0 or min(n for n, _, _ in statistics.values()) < max(min_trials, 2):
+        return False
+
+    if test_type == 'mushra':
+        return condition_confidence_interval_half_width(statistics, z) <= max_ci_half_width
+    elif test_type == 'pairwise':
+        for n, mean, _ in statistics.values():
+            lower, upper = wilson_interval(n, mean, z)
+            if lower <= 0.5 <= upper:
+                return False
+        return True
+    return False
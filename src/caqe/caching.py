@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process caches shared by the threads of a worker, and a file cache on disk shared by the workers of a host
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import urllib.parse as urlparse
+from collections import OrderedDict
+
+
+class ExpiringValue(object):
+    """
+    A single cached value that is recomputed when it is older than `ttl` seconds or has been invalidated.
+
+    Parameters
+    ----------
+    compute : callable
+        Function of no arguments that computes the value
+    ttl : float
+        Number of seconds the value is valid for
+
+    Examples
+    --------
+    >>> value = ExpiringValue(lambda: 42, 10.)
+    >>> value.get()
+    42
+    >>> value.invalidate()
+    """
+    def __init__(self, compute, ttl):
+        self.compute = compute
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the value, recomputing it if it has expired.
+
+        Returns
+        -------
+        object
+        """
+        with self._lock:
+            if time.time() < self._expires_at:
+                return self._value
+
+        # compute outside of the lock, so that a slow computation doesn't block the other threads
+        value = self.compute()
+        with self._lock:
+            self._value = value
+            self._expires_at = time.time() + self.ttl
+        return value
+
+    def invalidate(self):
+        """
+        Force the value to be recomputed on the next `get`.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._expires_at = 0.
+
+
+class LRUCache(object):
+    """
+    A mapping of bounded size that evicts the least recently used entries.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. If 0, nothing is cached.
+
+    Examples
+    --------
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value of `key`, marking it as recently used.
+
+        Parameters
+        ----------
+        key : hashable
+        default : object
+            Returned if `key` is not cached
+
+        Returns
+        -------
+        object
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        Cache `value` under `key`, evicting the least recently used entry if the cache is full.
+
+        Parameters
+        ----------
+        key : hashable
+        value : object
+
+        Returns
+        -------
+        None
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(object):
+    """
+    A read-through cache of files (e.g. audio from an external host) in a local directory, of bounded total size.
+    Files are named by the SHA-256 hash of their key, filled atomically, and the least recently used files are evicted.
+    Use is tracked by the access time of the files, so their modification time (e.g. the validators of HTTP responses)
+    only changes when they are filled. Several processes can share the directory.
+
+    Parameters
+    ----------
+    directory : str
+    max_size : int
+        Maximum total size of the cached files in bytes
+    lock_timeout : float
+        Number of seconds after which the fill of a file by another process is presumed to have failed
+    """
+    def __init__(self, directory, max_size, lock_timeout=60.):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        The path of the cached file of `key`. The extension of the key's path is kept, so that the mimetype of the file
+        can be guessed.
+
+        Parameters
+        ----------
+        key : str
+            E.g. a URL
+
+        Returns
+        -------
+        str
+        """
+        extension = os.path.splitext(urlparse.urlparse(key).path)[1]
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    def get(self, key):
+        """
+        Get the path of the cached file of `key`, marking it as recently used.
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        str
+            None if the file is not cached
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            return None
+        return path
+
+    def fill(self, key, fetch):
+        """
+        Cache the file of `key`, unless another process is already caching it.
+
+        Parameters
+        ----------
+        key : str
+        fetch : callable
+            Function of no arguments that returns an iterable of the file's contents as chunks of bytes
+
+        Returns
+        -------
+        str
+            The path of the cached file. None if another process is caching it.
+        """
+        path = self.path(key)
+        lock_path = path + '.lock'
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < self.lock_timeout:
+                    return None
+                # the process filling it died
+                os.remove(lock_path)
+            except OSError:
+                pass
+            return None
+
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in fetch():
+                        f.write(chunk)
+                # readers see either no file or the whole file
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        finally:
+            # another process may have removed the lock as stale if the fill took long
+            self._remove(lock_path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the total size of the cache is at most `max_size`, and remove
+        abandoned temporary files.
+
+        Parameters
+        ----------
+        keep : str, optional
+            The path of a file that is not removed (e.g. the one just filled, even if it is larger than `max_size`)
+
+        Returns
+        -------
+        None
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.tmp') or entry.name.endswith('.lock'):
+                if time.time() - stat.st_mtime > self.lock_timeout:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            self._remove(path)
+            total_size -= size
+
+    @staticmethod
+    def _remove(path):
+        # another process may have removed it already
+        try:
+            os.remove(path)
+        except OSError:
+            pass
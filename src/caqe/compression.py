@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Negotiated compression of responses, and serving of precompressed static files (see `COMPRESSION_ENABLED`)
+"""
+import gzip
+import io
+import mimetypes
+import os
+
+from flask import request, send_file, safe_join
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from caqe import app
+
+# file extensions of precompressed static files, by content-coding
+PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+def accepted_encodings():
+    """
+    Get the content-codings that are both accepted by the client and supported, in order of preference.
+
+    Returns
+    -------
+    encodings : list of str
+    """
+    encodings = []
+    if brotli is not None and request.accept_encodings['br'] > 0:
+        encodings.append('br')
+    if request.accept_encodings['gzip'] > 0:
+        encodings.append('gzip')
+    return encodings
+
+
+def compress(data, encoding):
+    """
+    Compress `data` with a content-coding.
+
+    Parameters
+    ----------
+    data : bytes
+    encoding : str
+        'br' or 'gzip'
+
+    Returns
+    -------
+    bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESSION_BROTLI_QUALITY'])
+    elif encoding == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=app.config['COMPRESSION_GZIP_LEVEL'], mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    raise ValueError('Unsupported content-coding %r' % encoding)
+
+
+def compress_response(response):
+    """
+    Compress a response body with the client's preferred content-coding, if it is of one of the
+    `COMPRESSION_MIMETYPES` and at least `COMPRESSION_MIN_SIZE` bytes. File responses (e.g. audio and static files) and
+    partial content are never compressed here. The ETag of a compressed response is suffixed with the content-coding,
+    and a request whose If-None-Match has that ETag gets a 304.
+
+    Parameters
+    ----------
+    response : flask.Response
+
+    Returns
+    -------
+    flask.Response
+    """
+    if not app.config['COMPRESSION_ENABLED'] \
+            or response.status_code != 200 \
+            or response.direct_passthrough \
+            or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in app.config['COMPRESSION_MIMETYPES']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encodings = accepted_encodings()
+    if len(encodings) == 0:
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+
+    # the compressed body is a different representation, so it can't share the strong ETag of the identity body
+    etag, weak = response.get_etag()
+    if etag is not None:
+        etag = '%s-%s' % (etag, encodings[0])
+        response.set_etag(etag, weak)
+        if request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+            response.set_data(b'')
+            return response
+
+    response.set_data(compress(data, encodings[0]))
+    response.headers['Content-Encoding'] = encodings[0]
+    return response
+
+
+def send_static_file(filename):
+    """
+    Send a static file, sending its precompressed version (see ``precompress_static.py``) instead if the client
+    accepts its content-coding and it is up to date. Replaces Flask's static file view function.
+
+    Parameters
+    ----------
+    filename : str
+        Path relative to the static folder
+
+    Returns
+    -------
+    flask.Response
+    """
+    path = safe_join(app.static_folder, filename)
+    if not os.path.isfile(path):
+        raise NotFound()
+
+    if app.config['PRECOMPRESSED_STATIC_ENABLED']:
+        for encoding in accepted_encodings():
+            compressed_path = path + PRECOMPRESSED_EXTENSIONS[encoding]
+            if os.path.isfile(compressed_path) and os.path.getmtime(compressed_path) >= os.path.getmtime(path):
+                response = send_file(compressed_path,
+                                     mimetype=mimetypes.guess_type(path)[0],
+                                     conditional=True,
+                                     cache_timeout=app.get_send_file_max_age(path))
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+
+    return app.send_static_file(filename)
+
+
+def precompress_static_files(static_folder, min_size, excluded_directories=()):
+    """
+    Write gzip (and, if available, brotli) compressed versions of the static files whose mimetype is one of the
+    `COMPRESSION_MIMETYPES`, next to them.
+
+    Parameters
+    ----------
+    static_folder : str
+    min_size : int
+        Files smaller than this many bytes are skipped
+    excluded_directories : list of str
+        Directories (relative to `static_folder`) to skip, e.g. the audio directory
+
+    Returns
+    -------
+    written : list of str
+        Paths of the compressed files written
+    """
+    excluded_directories = [os.path.normpath(os.path.join(static_folder, d)) for d in excluded_directories]
+    encodings = ['gzip'] + (['br'] if brotli is not None else [])
+    written = []
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        subdirectories[:] = [d for d in subdirectories
+                             if os.path.normpath(os.path.join(directory, d)) not in excluded_directories]
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            mimetype, encoding = mimetypes.guess_type(path)
+            # files that are already compressed (e.g. the outputs of a previous run) are skipped
+            if encoding is not None \
+                    or mimetype not in app.config['COMPRESSION_MIMETYPES'] \
+                    or os.path.getsize(path) < min_size:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in encodings:
+                compressed_path = path + PRECOMPRESSED_EXTENSIONS[encoding]
+                with open(compressed_path, 'wb') as f:
+                    f.write(compress(data, encoding))
+                written.append(compressed_path)
+    return written
@@ -78,6 +78,90 @@ class BaseConfig(object):
         Relative directory path to testing audio stimuli. (default is 'static/audio')
     ENCRYPT_AUDIO_STIMULI_URLS : bool
         Enable/disable encryption of the URLs so that users can't game consistency. (default is True)
+    SESSION_BACKEND : str or caqe.sessions.SessionStore
+        Where session data is kept. If 'cookie', in Flask's signed session cookie. If 'sqlite', in the local SQLite
+        database at `SESSION_SQLITE_PATH`, and the cookie holds only a session id. Set it to an instance of a
+        `caqe.sessions.SessionStore` subclass to keep sessions elsewhere (e.g. in a key-value store shared by several
+        hosts). The SQLite database is local to a host, so don't use it when requests are spread over several hosts or
+        the filesystem is ephemeral (e.g. Heroku, for which `ProductionOverrideConfig` uses 'cookie').
+        (default is 'sqlite')
+    SESSION_SQLITE_PATH : str
+        Path of the SQLite session database. (default is '~/caqe_sessions.db')
+    AUDIO_AUTHORIZATION_CACHE_SIZE : int
+        With server-side sessions, the maximum number of sessions whose participant and condition groups are cached in
+        each process to authorize audio requests without loading the session. 0 disables the cache. (default is 4096)
+    AUDIO_AUTHORIZATION_CACHE_SECONDS : float
+        The number of seconds a session's audio authorization is cached. (default is 60.)
+    COMPRESSION_ENABLED : bool
+        Compress responses of the `COMPRESSION_MIMETYPES` with brotli (if the `brotli` package is installed) or gzip,
+        as negotiated with the client. Audio and other file responses are never compressed. (default is True)
+    COMPRESSION_MIMETYPES : list of str
+        The mimetypes of responses (and static files) to compress.
+    COMPRESSION_MIN_SIZE : int
+        Responses (and static files) smaller than this many bytes aren't compressed. (default is 1024)
+    COMPRESSION_GZIP_LEVEL : int
+        (default is 6)
+    COMPRESSION_BROTLI_QUALITY : int
+        (default is 5)
+    PRECOMPRESSED_STATIC_ENABLED : bool
+        Serve the precompressed versions of static files written by `precompress_static.py`, if the client accepts
+        them. (default is True)
+    COMPACT_AUDIO_URL_TOKENS : bool
+        If True, encrypted audio URLs hold a short encrypted and signed token of the participant, group and stimulus
+        ids, which the server maps to the audio file, instead of the encrypted file path. Encrypted URLs are still accepted.
+        (default is True)
+    AUDIO_URL_TOKEN_CACHE_SIZE : int
+        The maximum number of decoded audio URL tokens cached in each process, so that the range requests for a
+        stimulus don't each decode its token. 0 disables the cache. (default is 8192)
+    STIMULUS_ENCODING_CACHE_SIZE : int
+        The maximum number of participants' stimulus encodings (see `caqe.models.StimulusEncoding`) cached in each
+        process. 0 disables the cache. (default is 4096)
+    EVALUATION_CONFIG_API_ENABLED : bool
+        If True, '/evaluation' redirects to a page shell that is the same for every participant of a test (so browsers
+        can cache it), and the page loads the participant's conditions and stimuli from '/evaluation/config' as JSON.
+        Only supported for the 'mushra', 'pairwise' and 'segmentation' test types. (default is False)
+    AUDIO_OFFLOAD : str
+        If set, the audio stimuli and hearing test files are sent by the front proxy instead of the app: the app only
+        authorizes the request and responds with an internal redirect header. 'x-accel-redirect' for nginx (see
+        `AUDIO_OFFLOAD_LOCATION`), or 'x-sendfile' for Apache's mod_xsendfile (or lighttpd). If None, the app sends the
+        files itself, which needs no proxy. (default is None)
+    AUDIO_OFFLOAD_LOCATION : str
+        The URI prefix of the nginx internal location that maps to `AUDIO_OFFLOAD_ROOT`, e.g. with
+        ``location /protected/ { internal; alias /path/to/CAQE/src/; }``. (default is '/protected/')
+    AUDIO_OFFLOAD_ROOT : str
+        The directory that `AUDIO_OFFLOAD_LOCATION` maps to. Files outside of it are sent by the app. If None, the
+        parent directory of the caqe package. (default is None)
+    AUDIO_REDIRECT_ENABLED : bool
+        If True, '/audio' authorizes the request and then redirects to a short-lived URL signed with
+        `caqe.utilities.sign_url_path`, at `AUDIO_REDIRECT_URL`, so that the audio is sent without the app. With
+        `ENCRYPT_AUDIO_STIMULI_URLS`, the redirects name the files by opaque aliases (see
+        `caqe.utilities.audio_file_alias`), so they don't reveal the stimuli. (default is False)
+    AUDIO_REDIRECT_URL : str
+        The base URL of the static file server or CDN that verifies the signed URLs, which get the file path (or
+        alias) appended and 'expires' and 'signature' query parameters. Run ``export_audio_aliases.py`` to make a
+        directory of the files under their aliases for it. If None, the app's own '/signed_audio' route, which verifies
+        the signatures and sends the files as '/audio' would. (default is None)
+    AUDIO_REDIRECT_TTL : int
+        Signed URLs are valid for between `AUDIO_REDIRECT_TTL` and twice as many seconds. Their expiry times are
+        rounded, so that URLs repeat and can be cached. (default is 300)
+    AUDIO_REDIRECT_SECRET_KEY : str
+        The key the URLs are signed with, shared with the file server. If None, `SECRET_KEY`. (default is None)
+    EXTERNAL_FILE_HOST : bool
+        If True, `AUDIO_FILE_DIRECTORY` is the URL of a remote host of the audio stimuli, and audio requests (including
+        their Range headers) are forwarded to it and the responses streamed back. (default is False)
+    EXTERNAL_FILE_HOST_TIMEOUT : tuple of float
+        The (connect, read) timeouts in seconds of requests to the external file host. (default is (5., 30.))
+    EXTERNAL_FILE_HOST_POOL_SIZE : int
+        The maximum number of keep-alive connections to the external file host kept by each process. (default is 16)
+    EXTERNAL_FILE_CACHE_ENABLED : bool
+        Cache the files of the external file host on local disk, in `EXTERNAL_FILE_CACHE_DIRECTORY`, and serve them from
+        there after the first request. Run ``prewarm_audio_cache.py`` to cache the stimuli of `TESTS` in advance.
+        (default is True)
+    EXTERNAL_FILE_CACHE_DIRECTORY : str
+        Directory of the external file cache, shared by the processes of a host. (default is '~/caqe_audio_cache')
+    EXTERNAL_FILE_CACHE_MAX_SIZE : int
+        Maximum total size in bytes of the external file cache. The least recently used files are evicted.
+        (default is 1024 ** 3)
     TEST_TYPE : str
         The test type (limited to 'pairwise' or 'mushra' for now). (default is None)
     ANONYMOUS_PARTICIPANTS_ENABLED : bool
@@ -110,9 +194,57 @@ class BaseConfig(object):
     TEST_CONDITION_ORDER_RANDOMIZED : bool
         Randomize the condition order per test for each participant. (default is True)
     TEST_CONDITION_GROUP_ORDER_RANDOMIZED : bool
-        Randomize the condition group order for each participant. (default is False)
+        Randomize the condition group order for each participant. Groups are sampled in proportion to the number of
+        trials they still need. (default is False)
+    CONDITION_ASSIGNMENT_ENGINE : str
+        How conditions are assigned to participants. 'query' queries the available conditions on each assignment.
+        'ticket' claims precomputed trial slots (one per remaining trial of each condition) instead of reserving slots
+        against the per-condition counts, so concurrent assignments don't contend for the ConditionCount rows. Both
+        choose groups by the same rule and assign the same conditions. (default is 'query')
+    CONDITION_RESERVATION_TTL_SECONDS : int
+        The number of seconds the trial slots of the conditions assigned to a participant are reserved for them, so that
+        concurrent participants are not assigned more than `TRIALS_PER_CONDITION` trials of a condition. Reservations
+        are released early when the trial is submitted or the participant is reassigned. Set to 0 to disable
+        reservations. (default is 60 * 30, i.e. 30 minutes)
+    CONDITION_ALLOCATION_POLICY : str
+        How trials are allocated among the available conditions. 'fixed' fills the conditions in order (see
+        `TEST_CONDITION_GROUP_ORDER_RANDOMIZED` and `TEST_CONDITION_ORDER_RANDOMIZED`). 'variance' samples groups in
+        proportion to the confidence interval widths of their conditions' mean ratings and assigns the conditions with
+        the widest intervals first, so that noisy conditions receive trials before conditions that have converged.
+        `TRIALS_PER_CONDITION` remains the maximum in either case. (default is 'fixed')
+    ALLOCATION_CONFIDENCE_Z : float
+        The standard score of the confidence level of the rating confidence intervals. (default is 1.96, i.e. 95%)
+    DESIGN_CACHE_SIZE : int
+        The maximum number of decoded tests, groups and conditions cached in each process, so that their JSON isn't
+        parsed on every evaluation. Least recently used entries are evicted first. 0 disables the cache.
+        (default is 4096)
+    DESIGN_VERSION_CHECK_SECONDS : float
+        The number of seconds between checks of the design version stamp in the database. When the design is inserted
+        again (e.g. with `create_db.py`), other processes discard their cached design within this time. (default is 10.)
+    EARLY_STOPPING_ENABLED : bool
+        If True, a condition is no longer assigned once its ratings (by participants that passed the hearing test) meet
+        the stopping rule of the test type, even if it has fewer than `TRIALS_PER_CONDITION` trials. For 'mushra', the
+        confidence interval half-width of every stimulus' mean rating must be at most
+        `EARLY_STOPPING_MAX_CI_HALF_WIDTH`. For 'pairwise', the confidence interval of the win probability of the
+        stimuli must exclude 0.5. Confidence intervals use `ALLOCATION_CONFIDENCE_Z`. (default is False)
+    EARLY_STOPPING_MIN_TRIALS : int
+        The minimum number of trials of a condition before it may be stopped early. (default is 5)
+    EARLY_STOPPING_MAX_CI_HALF_WIDTH : float
+        The MUSHRA rating confidence interval half-width at which a condition is stopped. (default is 5.)
+    REMAINING_CAPACITY_CACHE_SECONDS : float
+        The number of seconds the count of available conditions, which decides whether the "no more tasks" page is
+        shown on '/begin', is cached in each process. (default is 10.)
     STIMULUS_ORDER_RANDOMIZED : bool
         Randomize the stimulus order per for each condition. (default is True)
+    RANDOMIZATION_SALT : str
+        Salt of the stimulus order randomization. The order is seeded from the participant, the condition (or group)
+        and this salt, so a participant sees the same order, and the same audio URLs, every time the evaluation is
+        loaded. If None, `SECRET_KEY` is used. (default is None)
+    EVALUATION_CONFIG_CACHE_SIZE : int
+        The maximum number of generated evaluation configurations (one per participant and set of conditions) cached in
+        each process. 0 disables the cache. (default is 1024)
+    AUDIO_CACHE_MAX_AGE : int
+        The number of seconds browsers may cache stimulus audio for. (default is 43200)
     HEARING_SCREENING_TEST_ENABLED : bool
         Set to True if you want the participants to be required to take a hearing screening test. (default is True)
     HEARING_TEST_EXPIRATION_HOURS : int
@@ -249,7 +381,35 @@ class BaseConfig(object):
     AUDIO_FILE_DIRECTORY = os.getenv('AUDIO_FILE_DIRECTORY', 'static/audio')
     AUDIO_CODEC = 'wav'
     ENCRYPT_AUDIO_STIMULI_URLS = True
+    SESSION_BACKEND = 'sqlite'
+    SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', os.path.expanduser('~/caqe_sessions.db'))
+    AUDIO_AUTHORIZATION_CACHE_SIZE = 4096
+    AUDIO_AUTHORIZATION_CACHE_SECONDS = 60.
+    COMPRESSION_ENABLED = True
+    COMPRESSION_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript',
+                             'text/javascript']
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BROTLI_QUALITY = 5
+    PRECOMPRESSED_STATIC_ENABLED = True
+    COMPACT_AUDIO_URL_TOKENS = True
+    AUDIO_URL_TOKEN_CACHE_SIZE = 8192
+    STIMULUS_ENCODING_CACHE_SIZE = 4096
+    EVALUATION_CONFIG_API_ENABLED = False
+    AUDIO_OFFLOAD = None
+    AUDIO_OFFLOAD_LOCATION = '/protected/'
+    AUDIO_OFFLOAD_ROOT = None
+    AUDIO_REDIRECT_ENABLED = False
+    AUDIO_REDIRECT_URL = None
+    AUDIO_REDIRECT_TTL = 300
+    AUDIO_REDIRECT_SECRET_KEY = None
     EXTERNAL_FILE_HOST = False
+    EXTERNAL_FILE_HOST_TIMEOUT = (5., 30.)
+    EXTERNAL_FILE_HOST_POOL_SIZE = 16
+    EXTERNAL_FILE_CACHE_ENABLED = True
+    EXTERNAL_FILE_CACHE_DIRECTORY = os.getenv('EXTERNAL_FILE_CACHE_DIRECTORY',
+                                              os.path.expanduser('~/caqe_audio_cache'))
+    EXTERNAL_FILE_CACHE_MAX_SIZE = 1024 ** 3
     BEGIN_TITLE = 'Audio Quality Evaluation'
 
     # ---------------------------------------------------------------------------------------------
@@ -268,7 +428,20 @@ class BaseConfig(object):
     LIMIT_SUBJECT_TO_ONE_TASK_TYPE = True
     TEST_CONDITION_ORDER_RANDOMIZED = True
     TEST_CONDITION_GROUP_ORDER_RANDOMIZED = False
+    CONDITION_ASSIGNMENT_ENGINE = 'query'
+    CONDITION_RESERVATION_TTL_SECONDS = 60 * 30
+    CONDITION_ALLOCATION_POLICY = 'fixed'
+    ALLOCATION_CONFIDENCE_Z = 1.96
+    DESIGN_CACHE_SIZE = 4096
+    DESIGN_VERSION_CHECK_SECONDS = 10.
+    EARLY_STOPPING_ENABLED = False
+    EARLY_STOPPING_MIN_TRIALS = 5
+    EARLY_STOPPING_MAX_CI_HALF_WIDTH = 5.
+    REMAINING_CAPACITY_CACHE_SECONDS = 10.
     STIMULUS_ORDER_RANDOMIZED = True
+    RANDOMIZATION_SALT = None
+    EVALUATION_CONFIG_CACHE_SIZE = 1024
+    AUDIO_CACHE_MAX_AGE = 60 * 60 * 12
 
     # ---------------------------------------------------------------------------------------------
     # HEARING SCREENING VARIABLES
@@ -373,6 +546,8 @@ class ProductionOverrideConfig(object):
     """
     TESTING = False
     DEBUG = False
+    # Heroku dynos are separate machines with ephemeral filesystems, so a local session database would lose sessions
+    SESSION_BACKEND = 'cookie'
 
 
 class EvaluationDevOverrideConfig(object):
@@ -4,6 +4,7 @@
 Contains functions related to the experimental design of the listening test
 """
 import copy
+import hashlib
 import json
 import logging
 import random
@@ -11,11 +12,16 @@ import datetime
 import itertools
 from collections import defaultdict
 
-from sqlalchemy import func
+from sqlalchemy import case, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
+import caqe.allocation as allocation
 import caqe.utilities as utilities
+from caqe.caching import ExpiringValue, LRUCache
 
-from .models import Condition, Participant, Trial, Test, Group
+from .models import Condition, ConditionCount, ConditionReservation, ConditionTicket, ConfigBlob, DesignVersion, \
+    Participant, StimulusEncoding, Trial, Test, Group
 from caqe import db
 from caqe import app
 
@@ -56,13 +62,20 @@ def insert_tests_and_conditions(config=None):
     if config is None:
         config = app.config
         
+    # store app config variables as well for reference, once for all tests
+    shared_config = dict(config)
+    del shared_config['TESTS']
+    del shared_config['PERMANENT_SESSION_LIFETIME']  # a flask variable
+    if not isinstance(shared_config.get('SESSION_BACKEND'), str):
+        # a SessionStore instance can't be serialized
+        del shared_config['SESSION_BACKEND']
+    config_blob = ConfigBlob(json.dumps(shared_config, sort_keys=True))
+    if ConfigBlob.query.get(config_blob.hash) is None:
+        db.session.add(config_blob)
+        db.session.commit()
+
     for test_dict in config['TESTS']:
-        # store app config variables as well for reference
-        test_config = copy.deepcopy(config)
-        del test_config['TESTS']
-        del test_config['PERMANENT_SESSION_LIFETIME']  # a flask variable
-        test_config.update(test_dict['test_config_variables'])
-        test = Test(json.dumps(test_config))
+        test = Test(json.dumps(test_dict['test_config_variables']), config_blob.hash)
         db.session.add(test)
         db.session.commit()
 
@@ -76,11 +89,190 @@ def insert_tests_and_conditions(config=None):
                 c = Condition(test_id=test.id, group_id=group.id, data=json.dumps(condition_dict))
                 db.session.add(c)
                 db.session.commit()
+                db.session.add(ConditionCount(c.id))
+                db.session.add_all([ConditionTicket(c.id, group.id, test.id)
+                                    for _ in range(config['TRIALS_PER_CONDITION'])])
+                db.session.commit()
+
+    db.session.add(DesignVersion())
+    db.session.commit()
+    invalidate_design_cache()
+
+
+def _get_design_version():
+    """
+    Get the stamp of the most recently inserted design.
+    """
+    design_version = DesignVersion.query.order_by(DesignVersion.id.desc()).first()
+    return design_version.version if design_version is not None else None
+
+
+_design_version = ExpiringValue(_get_design_version, app.config['DESIGN_VERSION_CHECK_SECONDS'])
+_design_cache = LRUCache(app.config['DESIGN_CACHE_SIZE'])
+
+
+def invalidate_design_cache():
+    """
+    Discard the decoded tests, groups and conditions cached in this process. Other processes discard theirs when they
+    next check the design version stamp.
+
+    Returns
+    -------
+    None
+    """
+    _design_cache.clear()
+    _test_configurations.clear()
+    _audio_url_tokens.clear()
+    _stimulus_encodings.clear()
+    _design_version.invalidate()
+
+
+def get_test_data(test):
+    """
+    Decode the variables of a test, merging its own variables into the shared configuration it references. The shared
+    configuration is decoded once per process.
+
+    Parameters
+    ----------
+    test : caqe.models.Test
+
+    Returns
+    -------
+    test_data : dict
+    """
+    test_data = json.loads(test.data)
+    if test.config_hash is None:
+        return test_data
+
+    # configurations are immutable, so the hash alone identifies one
+    shared_config = _design_cache.get(('config', test.config_hash))
+    if shared_config is None:
+        shared_config = json.loads(ConfigBlob.query.get(test.config_hash).data)
+        _design_cache.put(('config', test.config_hash), shared_config)
+    return dict(shared_config, **test_data)
+
+
+def get_design_version():
+    """
+    Get the version stamp of the design, as last checked by this process (see `DESIGN_VERSION_CHECK_SECONDS`).
+
+    Returns
+    -------
+    str
+        None if the design was inserted before version stamps were kept
+    """
+    return _design_version.get()
+
+
+def get_cached_test_data(test_id):
+    """
+    Get the decoded variables of a test from the design cache. The returned data is shared with other requests, so
+    don't modify it.
+
+    Parameters
+    ----------
+    test_id : int
+
+    Returns
+    -------
+    test_data : dict
+        None if there is no such test
+    """
+    version = _design_version.get()
+    test_data = _design_cache.get(('test', test_id, version))
+    if test_data is None:
+        test = Test.query.get(test_id)
+        if test is None:
+            return None
+        test_data = get_test_data(test)
+        _design_cache.put(('test', test_id, version), test_data)
+    return test_data
+
+
+def get_condition_test_id(condition_id):
+    """
+    Get the id of the test a condition belongs to, from the design cache.
+
+    Parameters
+    ----------
+    condition_id : int
+
+    Returns
+    -------
+    int
+    """
+    conditions, _, _ = _get_decoded_design([condition_id])
+    return conditions[condition_id][0]
+
+
+def _get_decoded_design(condition_ids):
+    """
+    Get the decoded data of conditions and of the tests and groups they belong to, loading whatever isn't in the design
+    cache from the database. The returned data is shared with other requests, so copy it before modifying it.
+
+    Parameters
+    ----------
+    condition_ids : list of int
+
+    Returns
+    -------
+    conditions : dict
+        Map from condition id to a tuple of (test_id, group_id, condition data)
+    tests : dict
+        Map from test id to test data
+    groups : dict
+        Map from group id to group data
+    """
+    version = _design_version.get()
+    conditions = {}
+    tests = {}
+    groups = {}
+
+    def cached(kind, _id, decoded):
+        value = _design_cache.get((kind, _id, version))
+        if value is not None:
+            decoded[_id] = value
+        return value is not None
+
+    def store(kind, _id, data, decoded):
+        decoded[_id] = data
+        _design_cache.put((kind, _id, version), decoded[_id])
+
+    missing_condition_ids = [c_id for c_id in condition_ids if not cached('condition', c_id, conditions)]
+    if len(missing_condition_ids) > 0:
+        for condition in Condition.query.options(joinedload(Condition.test), joinedload(Condition.group)). \
+                filter(Condition.id.in_(missing_condition_ids)):
+            conditions[condition.id] = (condition.test_id, condition.group_id, json.loads(condition.data))
+            _design_cache.put(('condition', condition.id, version), conditions[condition.id])
+            if condition.test_id not in tests and not cached('test', condition.test_id, tests):
+                store('test', condition.test_id, get_test_data(condition.test), tests)
+            if condition.group_id not in groups and not cached('group', condition.group_id, groups):
+                store('group', condition.group_id, json.loads(condition.group.data), groups)
+
+    # tests and groups of cached conditions
+    missing_test_ids = set(test_id for test_id, _, _ in conditions.values()
+                           if test_id not in tests and not cached('test', test_id, tests))
+    if len(missing_test_ids) > 0:
+        for test in Test.query.filter(Test.id.in_(missing_test_ids)):
+            store('test', test.id, get_test_data(test), tests)
+    missing_group_ids = set(group_id for _, group_id, _ in conditions.values()
+                            if group_id not in groups and not cached('group', group_id, groups))
+    if len(missing_group_ids) > 0:
+        for group in Group.query.filter(Group.id.in_(missing_group_ids)):
+            store('group', group.id, json.loads(group.data), groups)
+
+    return conditions, tests, groups
 
 
 def get_available_conditions(limit_to_condition_ids=None):
     """
-    Get conditions available without regard to participant.
+    Get conditions available without regard to participant. A condition is available until it has received
+    `TRIALS_PER_CONDITION` trials from participants that passed the hearing test, as recorded in ConditionCount,
+    counting the trial slots that are currently reserved for other participants. Expired reservations are not counted,
+    even before `assign_conditions` releases them, so that abandoned reservations don't make the experiment look full
+    (e.g. to `get_remaining_capacity`). With the 'ticket' `CONDITION_ASSIGNMENT_ENGINE`, a condition is available while
+    it has an unclaimed ConditionTicket. Conditions that were stopped early (see `EARLY_STOPPING_ENABLED`) are not
+    available.
 
     Parameters
     ----------
@@ -92,10 +284,20 @@ def get_available_conditions(limit_to_condition_ids=None):
     conditions: list of Condition
         The available conditions
     """
-    finished_conditions = db.session.query(Trial.condition_id).filter(Trial.participant_passed_hearing_test == True). \
-        group_by(Trial.condition_id).having(func.count('*') >= app.config['TRIALS_PER_CONDITION']).subquery()
+    if app.config['CONDITION_ASSIGNMENT_ENGINE'] == 'ticket':
+        free_tickets = db.session.query(ConditionTicket.condition_id). \
+            filter(_free_ticket_criterion(datetime.datetime.now()))
+        conditions = db.session.query(Condition).outerjoin(ConditionCount). \
+            filter(Condition.id.in_(free_tickets.subquery()))
+    else:
+        expired = _expired_reservation_counts(datetime.datetime.now())
+        conditions = db.session.query(Condition).outerjoin(ConditionCount). \
+            outerjoin(expired, expired.c.condition_id == Condition.id). \
+            filter(func.coalesce(ConditionCount.passed_count, 0) + func.coalesce(ConditionCount.reserved_count, 0)
+                   - func.coalesce(expired.c.expired_count, 0) < app.config['TRIALS_PER_CONDITION'])
 
-    conditions = db.session.query(Condition).filter(Condition.id.notin_(finished_conditions))
+    # conditions stopped early
+    conditions = conditions.filter(func.coalesce(ConditionCount.finished, False) == False)
 
     if limit_to_condition_ids is not None:
         conditions = conditions.filter(Condition.id.in_(limit_to_condition_ids))
@@ -105,9 +307,389 @@ def get_available_conditions(limit_to_condition_ids=None):
     return conditions
 
 
+def _expired_reservation_counts(now):
+    """
+    Subquery of the number of expired ConditionReservations of each condition, which are still counted in
+    `reserved_count` until `release_expired_condition_reservations` releases them. Only the expired reservations are
+    read, by the index on `expires_at`.
+    """
+    return db.session.query(ConditionReservation.condition_id.label('condition_id'),
+                            func.count('*').label('expired_count')). \
+        filter(ConditionReservation.expires_at < now). \
+        group_by(ConditionReservation.condition_id).subquery()
+
+
+def _count_available_conditions():
+    return get_available_conditions().count()
+
+
+_remaining_capacity = ExpiringValue(_count_available_conditions, app.config['REMAINING_CAPACITY_CACHE_SECONDS'])
+
+
+def get_remaining_capacity():
+    """
+    Get the number of conditions available without regard to participant. The value is cached in the process for
+    `REMAINING_CAPACITY_CACHE_SECONDS` and refreshed early when this process saves a trial, so that it may be checked
+    on every page view (e.g. MTurk previews) without querying the database.
+
+    Returns
+    -------
+    int
+    """
+    return _remaining_capacity.get()
+
+
+def invalidate_remaining_capacity():
+    """
+    Refresh the remaining capacity on its next use. Call this after committing new trials, not before, so that the
+    count isn't recomputed from the data before the commit and cached again.
+
+    Returns
+    -------
+    None
+    """
+    _remaining_capacity.invalidate()
+
+
+def _reserve_condition(participant_id, condition_id, expires_at):
+    """
+    Reserve a trial slot of a condition for a participant. The check for a free slot and the increment of
+    `reserved_count` are a single conditional UPDATE, which locks the ConditionCount row, so concurrent reservations
+    can't exceed `TRIALS_PER_CONDITION`.
+
+    Returns
+    -------
+    bool
+        True if the slot was reserved
+    """
+    def reserve():
+        return db.session.query(ConditionCount). \
+            filter(ConditionCount.condition_id == condition_id). \
+            filter(ConditionCount.passed_count + ConditionCount.reserved_count < app.config['TRIALS_PER_CONDITION']). \
+            update({ConditionCount.reserved_count: ConditionCount.reserved_count + 1}, synchronize_session=False)
+
+    reserved = reserve()
+    if not reserved and db.session.query(ConditionCount.condition_id). \
+            filter(ConditionCount.condition_id == condition_id).first() is None:
+        # the count has not been created for this condition (e.g. the database predates ConditionCount)
+        try:
+            with db.session.begin_nested():
+                db.session.add(ConditionCount(condition_id))
+        except IntegrityError:
+            # created by a concurrent request
+            pass
+        reserved = reserve()
+
+    if reserved:
+        db.session.add(ConditionReservation(condition_id, participant_id, expires_at))
+    return bool(reserved)
+
+
+def _release_condition_reservations(reservations):
+    """
+    Delete the reservations and decrement the `reserved_count` of their conditions. A reservation that was already
+    released (e.g. by a concurrent request) is not decremented again.
+
+    Parameters
+    ----------
+    reservations : list of tuple
+        (id, condition_id) of the ConditionReservations
+    """
+    for reservation_id, condition_id in sorted(reservations, key=lambda r: r[1]):
+        deleted = db.session.query(ConditionReservation). \
+            filter(ConditionReservation.id == reservation_id). \
+            delete(synchronize_session=False)
+        if deleted:
+            db.session.query(ConditionCount). \
+                filter(ConditionCount.condition_id == condition_id). \
+                update({ConditionCount.reserved_count: ConditionCount.reserved_count - 1}, synchronize_session=False)
+
+
+def release_condition_reservations(participant_id, condition_id=None):
+    """
+    Release the reservations held by a participant.
+
+    Parameters
+    ----------
+    participant_id : int
+    condition_id : int, optional
+        Only release the reservation of this condition
+
+    Returns
+    -------
+    None
+    """
+    reservations = db.session.query(ConditionReservation.id, ConditionReservation.condition_id). \
+        filter(ConditionReservation.participant_id == participant_id)
+    if condition_id is not None:
+        reservations = reservations.filter(ConditionReservation.condition_id == condition_id)
+    _release_condition_reservations(reservations.all())
+
+
+def release_expired_condition_reservations():
+    """
+    Release all reservations that have expired, and commit if there were any.
+
+    Returns
+    -------
+    None
+    """
+    expired = db.session.query(ConditionReservation.id, ConditionReservation.condition_id). \
+        filter(ConditionReservation.expires_at < datetime.datetime.now()).all()
+    if len(expired) > 0:
+        _release_condition_reservations(expired)
+        db.session.commit()
+        logger.info('Released %d expired condition reservations' % len(expired))
+
+
+def increment_condition_count(condition_id, participant_passed_hearing_test):
+    """
+    Count a newly inserted trial in the condition's ConditionCount. This is done with a single UPDATE in the current
+    transaction, so call it alongside the insert of the Trial and before the session is committed.
+
+    Parameters
+    ----------
+    condition_id : int
+    participant_passed_hearing_test : bool
+
+    Returns
+    -------
+    None
+    """
+    if participant_passed_hearing_test:
+        column = ConditionCount.passed_count
+    else:
+        column = ConditionCount.failed_count
+
+    updated = db.session.query(ConditionCount).filter(ConditionCount.condition_id == condition_id). \
+        update({column: column + 1}, synchronize_session=False)
+
+    if updated == 0:
+        # the count has not been created for this condition (e.g. the database predates ConditionCount)
+        if participant_passed_hearing_test:
+            db.session.add(ConditionCount(condition_id, passed_count=1))
+        else:
+            db.session.add(ConditionCount(condition_id, failed_count=1))
+
+
+def update_condition_rating_statistics(condition_id, trial_data):
+    """
+    Add the ratings of a newly inserted trial to the condition's running rating statistics, and evaluate the early
+    stopping rule. The ConditionCount row is locked until the transaction is committed, so call this before the session
+    is committed.
+
+    Parameters
+    ----------
+    condition_id : int
+    trial_data : dict
+        The (decrypted) trial data, with the ratings keyed by stimulus in 'ratings'
+
+    Returns
+    -------
+    None
+    """
+    condition_count = db.session.query(ConditionCount). \
+        filter(ConditionCount.condition_id == condition_id). \
+        with_for_update().first()
+    if condition_count is None:
+        return
+
+    if condition_count.rating_statistics is None:
+        statistics = {}
+    else:
+        statistics = json.loads(condition_count.rating_statistics)
+    allocation.update_rating_statistics(statistics, trial_data.get('ratings', {}))
+    _set_condition_rating_statistics(condition_count, statistics)
+
+    if condition_count.finished:
+        logger.info('Condition %r met the early stopping rule' % condition_id)
+
+
+def _set_condition_rating_statistics(condition_count, statistics):
+    """
+    Store the rating statistics of a condition along with the values derived from them.
+    """
+    condition_count.rating_statistics = json.dumps(statistics)
+    condition_count.rating_ci_half_width = \
+        allocation.condition_confidence_interval_half_width(statistics, app.config['ALLOCATION_CONFIDENCE_Z'])
+    condition_count.finished = app.config['EARLY_STOPPING_ENABLED'] and \
+        allocation.meets_stopping_rule(statistics,
+                                       app.config['TEST_TYPE'],
+                                       app.config['EARLY_STOPPING_MIN_TRIALS'],
+                                       app.config['EARLY_STOPPING_MAX_CI_HALF_WIDTH'],
+                                       app.config['ALLOCATION_CONFIDENCE_Z'])
+
+
+def rebuild_condition_counts():
+    """
+    Recompute the ConditionCount table, including the rating statistics, from the Trial and ConditionReservation
+    tables.
+
+    Returns
+    -------
+    None
+    """
+    passed_counts = defaultdict(int)
+    failed_counts = defaultdict(int)
+    for condition_id, passed, count in db.session.query(Trial.condition_id,
+                                                         Trial.participant_passed_hearing_test,
+                                                         func.count('*')). \
+            group_by(Trial.condition_id, Trial.participant_passed_hearing_test):
+        if passed:
+            passed_counts[condition_id] += count
+        else:
+            failed_counts[condition_id] += count
+
+    reserved_counts = dict(db.session.query(ConditionReservation.condition_id, func.count('*')).
+                           group_by(ConditionReservation.condition_id).all())
+
+    rating_statistics = defaultdict(dict)
+    for condition_id, data in db.session.query(Trial.condition_id, Trial.data). \
+            filter(Trial.participant_passed_hearing_test == True).yield_per(1000):
+        allocation.update_rating_statistics(rating_statistics[condition_id], json.loads(data).get('ratings', {}))
+
+    db.session.query(ConditionCount).delete(synchronize_session=False)
+    for (condition_id,) in db.session.query(Condition.id):
+        condition_count = ConditionCount(condition_id,
+                                         passed_count=passed_counts[condition_id],
+                                         failed_count=failed_counts[condition_id],
+                                         reserved_count=reserved_counts.get(condition_id, 0))
+        if condition_id in rating_statistics:
+            _set_condition_rating_statistics(condition_count, rating_statistics[condition_id])
+        db.session.add(condition_count)
+    db.session.commit()
+    logger.info('Rebuilt condition counts from %d trials' % (sum(passed_counts.values()) +
+                                                              sum(failed_counts.values())))
+
+
+def rebuild_condition_tickets():
+    """
+    Recreate the unclaimed ConditionTickets of each condition from its ConditionCount, i.e. `TRIALS_PER_CONDITION`
+    minus the number of trials by participants that passed the hearing test. Existing claims are discarded.
+
+    Returns
+    -------
+    None
+    """
+    db.session.query(ConditionTicket).delete(synchronize_session=False)
+    for condition_id, group_id, test_id, passed_count in \
+            db.session.query(Condition.id, Condition.group_id, Condition.test_id, ConditionCount.passed_count). \
+            outerjoin(ConditionCount):
+        remaining = app.config['TRIALS_PER_CONDITION'] - (passed_count or 0)
+        db.session.add_all([ConditionTicket(condition_id, group_id, test_id) for _ in range(max(remaining, 0))])
+    db.session.commit()
+
+
+def _free_ticket_criterion(now):
+    return or_(ConditionTicket.participant_id == None, ConditionTicket.expires_at < now)
+
+
+def release_condition_tickets(participant_id, condition_id=None):
+    """
+    Release the tickets claimed by a participant so that others may claim them.
+
+    Parameters
+    ----------
+    participant_id : int
+    condition_id : int, optional
+        Only release the claim on this condition
+
+    Returns
+    -------
+    None
+    """
+    tickets = db.session.query(ConditionTicket).filter(ConditionTicket.participant_id == participant_id)
+    if condition_id is not None:
+        tickets = tickets.filter(ConditionTicket.condition_id == condition_id)
+    tickets.update({ConditionTicket.participant_id: None, ConditionTicket.expires_at: None},
+                   synchronize_session=False)
+
+
+def consume_condition_ticket(participant_id, condition_id):
+    """
+    Remove a ticket of a condition because a trial has been completed. The participant's own claim is consumed if it is
+    still held, otherwise any free ticket of the condition is.
+
+    Parameters
+    ----------
+    participant_id : int
+    condition_id : int
+
+    Returns
+    -------
+    None
+    """
+    ticket_id = db.session.query(ConditionTicket.id). \
+        filter(ConditionTicket.condition_id == condition_id). \
+        filter(ConditionTicket.participant_id == participant_id).first()
+
+    if ticket_id is None:
+        ticket_id = db.session.query(ConditionTicket.id). \
+            filter(ConditionTicket.condition_id == condition_id). \
+            filter(_free_ticket_criterion(datetime.datetime.now())). \
+            order_by(ConditionTicket.id).first()
+
+    if ticket_id is None:
+        logger.info('No tickets left to consume for condition %r' % condition_id)
+    else:
+        db.session.query(ConditionTicket).filter(ConditionTicket.id == ticket_id[0]).delete(synchronize_session=False)
+
+
+def record_trial(trial):
+    """
+    Update the condition bookkeeping for a newly inserted trial. Call this in the same transaction as the insert, i.e.
+    before the session is committed, and call `invalidate_remaining_capacity` after the commit. To record several
+    trials in one transaction, use `record_trials`.
+
+    Parameters
+    ----------
+    trial : caqe.models.Trial
+
+    Returns
+    -------
+    None
+    """
+    increment_condition_count(trial.condition_id, trial.participant_passed_hearing_test)
+    release_condition_reservations(trial.participant_id, trial.condition_id)
+
+    participant = Participant.query.get(trial.participant_id)
+    if participant.get_locked_test_id() is None:
+        test_id = db.session.query(Condition.test_id).filter(Condition.id == trial.condition_id).scalar()
+    else:
+        test_id = None
+    participant.add_completed_condition(trial.condition_id, test_id)
+
+    if trial.participant_passed_hearing_test:
+        consume_condition_ticket(trial.participant_id, trial.condition_id)
+        update_condition_rating_statistics(trial.condition_id, json.loads(trial.data))
+    else:
+        # the trial does not count towards TRIALS_PER_CONDITION, so let somebody else have the slot
+        release_condition_tickets(trial.participant_id, trial.condition_id)
+
+
+def record_trials(trials):
+    """
+    Update the condition bookkeeping for the newly inserted trials of a submission (see `record_trial`). The trials are
+    recorded in order of condition id, whatever the order in which they were submitted, so that concurrent submissions
+    of overlapping conditions lock the rows of those conditions in the same order instead of deadlocking.
+
+    Parameters
+    ----------
+    trials : list of caqe.models.Trial
+
+    Returns
+    -------
+    None
+    """
+    for trial in sorted(trials, key=lambda t: t.condition_id):
+        record_trial(trial)
+
+
 def assign_conditions(participant, limit_to_condition_ids=None):
     """
-    Assign experimental conditions for a participant's trial.
+    Assign experimental conditions for a participant's trial. The assigned conditions are held for the participant for
+    `CONDITION_RESERVATION_TTL_SECONDS`, by a ConditionReservation or a ConditionTicket claim depending on the
+    `CONDITION_ASSIGNMENT_ENGINE`.
 
     Parameters
     ----------
@@ -127,47 +709,266 @@ def assign_conditions(participant, limit_to_condition_ids=None):
     # If the participant has not passed the listening test:
     #   Same as above. This may give us a bit more ratings from lower condition indices for people that have not passed
     #   the listening test, but I think that is ok.
+    ticket_engine = app.config['CONDITION_ASSIGNMENT_ENGINE'] == 'ticket'
 
-    # construct our subqueries
-    # conditions which have the required number of trials with hearing_test passed participants
+    # the participant is being (re)assigned, so give up anything they are holding
+    if ticket_engine:
+        release_condition_tickets(participant.id)
+    else:
+        release_condition_reservations(participant.id)
+        release_expired_condition_reservations()
+    db.session.commit()
+
+    if ticket_engine:
+        return _assign_ticket_conditions(participant, limit_to_condition_ids)
+
+    # conditions which have not received the required number of trials and which the participant has not done yet
     conditions = get_available_conditions(limit_to_condition_ids)
+    completed_condition_ids = participant.get_completed_condition_ids()
+    if len(completed_condition_ids) > 0:
+        conditions = conditions.filter(~Condition.id.in_(completed_condition_ids))
+
+    # count the conditions and remaining trial slots of each group in the database, and choose one group
+    remaining_slots = app.config['TRIALS_PER_CONDITION'] - func.coalesce(ConditionCount.passed_count, 0) - \
+        func.coalesce(ConditionCount.reserved_count, 0)
+    groups = conditions.with_entities(Condition.group_id.label('group_id'),
+                                      func.count(Condition.id).label('condition_count'),
+                                      func.sum(case([(remaining_slots < 1, 1)], else_=remaining_slots)).
+                                      label('remaining_slots'),
+                                      *_width_aggregates(ConditionCount.rating_ci_half_width)). \
+        group_by(Condition.group_id). \
+        order_by(None).order_by(Condition.group_id).all()
+    group_id = _choose_group(groups)
+    if group_id is None:
+        logger.info('No hits left for %r' % participant)
+        return None
+
+    # only the conditions of the chosen group are loaded
+    conditions = conditions.filter(Condition.group_id == group_id). \
+        with_entities(Condition.id, Condition.test_id, ConditionCount.rating_ci_half_width).all()
+
+    hold = _reserve_condition if app.config['CONDITION_RESERVATION_TTL_SECONDS'] else None
+    return _assign_group_conditions(participant, group_id, conditions, hold)
 
-    # the conditions the participant has already done
-    participant_conditions = db.session.query(Trial.condition_id).join(Participant). \
-        filter(Participant.id == participant.id).subquery()
 
-    conditions = conditions.filter(Condition.id.notin_(participant_conditions))
+def _width_aggregates(width):
+    """
+    The aggregates of the confidence interval widths of a group's conditions used by `_choose_group`.
+    """
+    return (func.count(width).label('width_count'),
+            func.sum(width).label('width_sum'),
+            func.max(width).label('max_width'))
 
-    # find which group has the most conditions for this participant
 
-    if app.config['TEST_CONDITION_GROUP_ORDER_RANDOMIZED']:
-        group_id = db.session.query(Condition.group_id).filter(Condition.id.in_([c.id for c in conditions.all()])). \
-            group_by(Condition.group_id). \
-            order_by(func.random()).first()[0]
+def _choose_group(groups):
+    """
+    Choose the group to assign conditions of, by the same rule for either `CONDITION_ASSIGNMENT_ENGINE`:
+
+    * with the 'variance' `CONDITION_ALLOCATION_POLICY`, a group is sampled in proportion to the uncertainty of its
+      conditions' ratings,
+    * else if groups are randomized (see `TEST_CONDITION_GROUP_ORDER_RANDOMIZED`), a group is sampled in proportion to
+      the trials it still needs,
+    * otherwise the group with the most conditions for the participant is chosen (the lowest id of those tied).
+
+    Parameters
+    ----------
+    groups : list
+        Rows with the `group_id`, `condition_count`, `remaining_slots`, `width_count`, `width_sum` and `max_width` of
+        each group with conditions available to the participant, ordered by group id
+
+    Returns
+    -------
+    int
+        The group id, or None if there are no groups
+    """
+    if len(groups) == 0:
+        return None
+
+    if app.config['CONDITION_ALLOCATION_POLICY'] == 'variance':
+        weights = allocation.group_allocation_weights([(g.condition_count, g.width_count, g.width_sum, g.max_width)
+                                                       for g in groups])
+        return _weighted_choice(list(zip([g.group_id for g in groups], weights)))
+    elif app.config['TEST_CONDITION_GROUP_ORDER_RANDOMIZED']:
+        return _weighted_choice([(g.group_id, g.remaining_slots) for g in groups])
     else:
-        group_id = db.session.query(Condition.group_id).filter(Condition.id.in_([c.id for c in conditions.all()])). \
-            group_by(Condition.group_id). \
-            order_by(func.count(Condition.group_id).desc()).first()[0]
-    condition_group_ids = [group_id,]
+        return min(groups, key=lambda g: (-g.condition_count, g.group_id)).group_id
 
-    # limit to one group
-    conditions = conditions.filter(Condition.group_id == group_id).order_by(Condition.id).all()
 
-    if conditions is None or len(conditions) == 0:
+def _assign_group_conditions(participant, group_id, conditions, hold):
+    """
+    Assign up to `CONDITIONS_PER_EVALUATION` of the available conditions of the chosen group to a participant.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+    group_id : int
+    conditions : list
+        Rows with the `id`, `test_id` and `rating_ci_half_width` of the group's conditions available to the
+        participant, ordered by id
+    hold : callable
+        `_reserve_condition` or `_claim_condition_ticket`, or None if the conditions are not held
+
+    Returns
+    -------
+    condition_ids : list of int
+    condition_group_ids : list of int
+    """
+    if len(conditions) == 0:
         logger.info('No hits left for %r' % participant)
         return None
 
     if app.config['LIMIT_SUBJECT_TO_ONE_TASK_TYPE']:
-        previous_trial = participant.trials.first()
-        try:
-            if previous_trial.condition.test_id != conditions[0].test_id:
-                # If the participant is supposed to be limited to one task type, and we are out of all task of that type
-                logger.info('Subject limited to ont task type. No hits left for %r' % participant)
-                return None
-        except AttributeError:
-            # no previous trials
-            pass
+        locked_test_id = participant.get_locked_test_id()
+        if locked_test_id is not None and locked_test_id != conditions[0].test_id:
+            # If the participant is supposed to be limited to one task type, and we are out of all task of that type
+            logger.info('Subject limited to ont task type. No hits left for %r' % participant)
+            return None
+
+    condition_ids = _order_condition_ids(conditions)
+    if app.config['CONDITION_ALLOCATION_POLICY'] == 'variance':
+        condition_weights = dict(zip([c.id for c in conditions],
+                                     allocation.allocation_weights([c.rating_ci_half_width for c in conditions])))
+        # the widest confidence intervals first (the sort is stable, so ties keep their order)
+        condition_ids.sort(key=lambda c_id: -condition_weights[c_id])
+    if hold is not None:
+        condition_ids = _hold_conditions(participant, condition_ids, hold)
+        if len(condition_ids) == 0:
+            logger.info('No hits left for %r' % participant)
+            return None
+    else:
+        condition_ids = condition_ids[:app.config['CONDITIONS_PER_EVALUATION']]
+
+    logger.info('Participant %r assigned conditions: %r in groups: %r' % (participant, condition_ids, [group_id]))
+    return condition_ids, [group_id]
+
+
+def _hold_conditions(participant, condition_ids, hold):
+    """
+    Hold up to `CONDITIONS_PER_EVALUATION` of the conditions for a participant, in order.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+    condition_ids : list of int
+        The candidate conditions in the order in which they should be assigned
+    hold : callable
+        `_reserve_condition` or `_claim_condition_ticket`
+
+    Returns
+    -------
+    held_condition_ids : list of int
+    """
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=app.config['CONDITION_RESERVATION_TTL_SECONDS'])
+    held_condition_ids = []
+    for condition_id in condition_ids:
+        if len(held_condition_ids) == app.config['CONDITIONS_PER_EVALUATION']:
+            break
+        held = hold(participant.id, condition_id, expires_at)
+        # commit each hold, so that no transaction holds row locks of several conditions (taken in random order,
+        # which would deadlock concurrent assignments in the same group)
+        db.session.commit()
+        if held:
+            held_condition_ids.append(condition_id)
+    return held_condition_ids
+
+
+def _free_tickets(limit_to_condition_ids, excluded_condition_ids):
+    """
+    Query the free ConditionTickets, optionally limited to some conditions.
+    """
+    tickets = db.session.query(ConditionTicket).filter(_free_ticket_criterion(datetime.datetime.now()))
+    if limit_to_condition_ids is not None:
+        tickets = tickets.filter(ConditionTicket.condition_id.in_(limit_to_condition_ids))
+    if len(excluded_condition_ids) > 0:
+        tickets = tickets.filter(~ConditionTicket.condition_id.in_(excluded_condition_ids))
+    return tickets
+
+
+def _assign_ticket_conditions(participant, limit_to_condition_ids=None):
+    """
+    Assign conditions with the 'ticket' `CONDITION_ASSIGNMENT_ENGINE`: choose one group with free tickets by the same
+    rule as the 'query' engine (see `_choose_group`), counting a condition's free tickets as its remaining trial slots,
+    and claim up to `CONDITIONS_PER_EVALUATION` tickets of its conditions. The groups are counted by a single aggregate
+    query, and only the conditions of the chosen group are loaded.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+    limit_to_condition_ids : list, optional
+
+    Returns
+    -------
+    condition_ids : list of int
+    condition_group_ids : list of int
+    """
+    # the free tickets of each condition that the participant has not done yet
+    tickets = _free_tickets(limit_to_condition_ids, participant.get_completed_condition_ids()). \
+        with_entities(ConditionTicket.condition_id.label('id'),
+                      ConditionTicket.group_id.label('group_id'),
+                      ConditionTicket.test_id.label('test_id'),
+                      func.count('*').label('free_tickets')). \
+        group_by(ConditionTicket.condition_id, ConditionTicket.group_id, ConditionTicket.test_id).subquery()
+
+    # conditions stopped early
+    conditions = db.session.query(tickets).outerjoin(ConditionCount, ConditionCount.condition_id == tickets.c.id). \
+        filter(func.coalesce(ConditionCount.finished, False) == False)
+
+    groups = conditions.with_entities(tickets.c.group_id.label('group_id'),
+                                      func.count(tickets.c.id).label('condition_count'),
+                                      func.sum(tickets.c.free_tickets).label('remaining_slots'),
+                                      *_width_aggregates(ConditionCount.rating_ci_half_width)). \
+        group_by(tickets.c.group_id). \
+        order_by(tickets.c.group_id).all()
+    group_id = _choose_group(groups)
+    if group_id is None:
+        logger.info('No hits left for %r' % participant)
+        return None
+
+    conditions = conditions.filter(tickets.c.group_id == group_id). \
+        with_entities(tickets.c.id, tickets.c.test_id, ConditionCount.rating_ci_half_width). \
+        order_by(tickets.c.id).all()
+
+    return _assign_group_conditions(participant, group_id, conditions, _claim_condition_ticket)
+
+
+def _weighted_choice(weighted_items):
+    """
+    Choose an item at random with probability proportional to its weight.
+
+    Parameters
+    ----------
+    weighted_items : list of tuple
+        (item, weight) pairs with positive weights
+
+    Returns
+    -------
+    object
+        The chosen item
+    """
+    total = sum(weight for _, weight in weighted_items)
+    threshold = random.random() * total
+    cumulative = 0
+    for item, weight in weighted_items:
+        cumulative += weight
+        if threshold < cumulative:
+            return item
+    return weighted_items[-1][0]
+
+
+def _order_condition_ids(conditions):
+    """
+    Order the candidate conditions of a group for assignment.
 
+    Parameters
+    ----------
+    conditions : list
+        Objects with `id` and `test_id` attributes (e.g. Condition) ordered by id.
+
+    Returns
+    -------
+    condition_ids : list of int
+        All of the candidate condition ids in the order in which they should be assigned.
+    """
     if app.config['TEST_CONDITION_ORDER_RANDOMIZED']:  # i.e. randomize the condition order within a test
         # determine what test we are on
         current_test_id = conditions[0].test_id
@@ -175,25 +976,62 @@ def assign_conditions(participant, limit_to_condition_ids=None):
         # randomize the order of the conditions within that test
         condition_ids = [c.id for c in conditions if c.test_id == current_test_id]
         random.shuffle(condition_ids)
-        condition_ids = condition_ids[:app.config['CONDITIONS_PER_EVALUATION']]
 
         # if there are not enough conditions left from this test, add more from the next.
-        if len(condition_ids) < app.config['CONDITIONS_PER_EVALUATION']:
-            more_cids = [c.id for c in conditions if c.test_id == current_test_id + 1]
-            random.shuffle(more_cids)
-            condition_ids += more_cids[:(app.config['CONDITIONS_PER_EVALUATION'] - len(condition_ids))]
+        more_cids = [c.id for c in conditions if c.test_id == current_test_id + 1]
+        random.shuffle(more_cids)
+        condition_ids += more_cids
     else:
-        condition_ids = [c.id for c in conditions[:app.config['CONDITIONS_PER_EVALUATION']]]
+        condition_ids = [c.id for c in conditions]
+    return condition_ids
+
+
+def _claim_condition_ticket(participant_id, condition_id, expires_at, max_attempts=3):
+    """
+    Claim a free ticket of a condition for a participant. The claim is a conditional UPDATE, so a ticket that was
+    claimed concurrently by another participant is skipped.
+
+    Returns
+    -------
+    bool
+        True if a ticket was claimed
+    """
+    for _ in range(max_attempts):
+        now = datetime.datetime.now()
+        ticket_id = db.session.query(ConditionTicket.id). \
+            filter(ConditionTicket.condition_id == condition_id). \
+            filter(_free_ticket_criterion(now)). \
+            order_by(ConditionTicket.id).first()
+        if ticket_id is None:
+            return False
 
-    logger.info('Participant %r assigned conditions: %r in groups: %r' % (participant,
-                                                                          condition_ids,
-                                                                          condition_group_ids))
-    return condition_ids, condition_group_ids
+        claimed = db.session.query(ConditionTicket). \
+            filter(ConditionTicket.id == ticket_id[0]). \
+            filter(_free_ticket_criterion(now)). \
+            update({ConditionTicket.participant_id: participant_id, ConditionTicket.expires_at: expires_at},
+                   synchronize_session=False)
+        if claimed:
+            return True
+    return False
+
+
+def _seeded_random(participant_id, kind, _id):
+    """
+    A random number generator seeded from the participant, a test design object and the `RANDOMIZATION_SALT`.
+    """
+    salt = app.config['RANDOMIZATION_SALT'] or app.config['SECRET_KEY']
+    seed = hashlib.sha256(('%s:%s:%s:%s' % (salt, participant_id, kind, _id)).encode('utf-8')).hexdigest()
+    return random.Random(int(seed, 16))
+
+
+_test_configurations = LRUCache(app.config['EVALUATION_CONFIG_CACHE_SIZE'])
 
 
 def get_test_configurations(condition_ids, participant_id):
     """
-    Generate template configuration variables from the list of experimental conditions.
+    Generate template configuration variables from the list of experimental conditions. The stimulus order is
+    randomized deterministically per participant (see `RANDOMIZATION_SALT`), so the configuration is the same every
+    time, and is cached. It is shared with other requests, so don't modify it.
 
     Parameters
     ----------
@@ -206,46 +1044,129 @@ def get_test_configurations(condition_ids, participant_id):
         A list of dictionaries containing all the configuration variables for each test, including a list of conditions
         and their variables
     """
+    key = (participant_id, tuple(condition_ids), _design_version.get())
+    test_configurations = _test_configurations.get(key)
+    if test_configurations is not None:
+        return test_configurations
+
     test_configurations = []
 
+    conditions, tests, groups = _get_decoded_design(condition_ids)
+
+    # randomize and encrypt each group only once
+    group_data = {}
+    encoding_maps = {}
+    stimulus_encodings = {}
+
     current_test_id = None
     test_config = None
     for c_id in condition_ids:
-        condition = Condition.query.filter_by(id=c_id).first()
-        if condition.test_id != current_test_id:
+        test_id, group_id, condition_data = conditions[c_id]
+        if group_id not in group_data:
+            condition_group_data = copy.deepcopy(groups[group_id])
+
+            if app.config['STIMULUS_ORDER_RANDOMIZED']:
+                _seeded_random(participant_id, 'group', group_id).shuffle(condition_group_data['stimulus_files'])
+
+            if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
+                condition_group_data['reference_files'] = \
+                    encrypt_audio_stimuli(condition_group_data['reference_files'], participant_id, group_id)
+                condition_group_data['stimulus_files'] = \
+                    encrypt_audio_stimuli(condition_group_data['stimulus_files'], participant_id, group_id)
+                encoding_maps[group_id], decoding_map, filenames = \
+                    get_encoding_maps(condition_group_data['stimulus_files'])
+                stimulus_encodings[group_id] = {'decoding_map': decoding_map, 'filenames': filenames}
+
+            group_data[group_id] = condition_group_data
+
+        if test_id != current_test_id:
             if test_config is not None:
                 test_configurations.append(test_config)
-            current_test_id = condition.test_id
-            test_config = {'test': json.loads(condition.test.data),
+            current_test_id = test_id
+            # the test data is only read by the templates, so it is shared rather than copied
+            test_config = {'test': tests[test_id],
                            'conditions': [],
                            'condition_groups': {}}
 
-        condition_data = json.loads(condition.data)
-        condition_group_data = json.loads(condition.group.data)
+        condition_data = copy.deepcopy(condition_data)
 
         if app.config['STIMULUS_ORDER_RANDOMIZED']:
-            random.shuffle(condition_group_data['stimulus_files'])
-            random.shuffle(condition_data['stimulus_keys'])
+            _seeded_random(participant_id, 'condition', c_id).shuffle(condition_data['stimulus_keys'])
 
         if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
-            condition_group_data['reference_files'] = encrypt_audio_stimuli(condition_group_data['reference_files'],
-                                                                            participant_id,
-                                                                            condition.group_id)
-            condition_group_data['stimulus_files'] = encrypt_audio_stimuli(condition_group_data['stimulus_files'],
-                                                                           participant_id,
-                                                                           condition.group_id)
-            encoding_map, _, _ = get_encoding_maps(condition_group_data['stimulus_files'])
+            encoding_map = encoding_maps[group_id]
             condition_data['stimulus_keys'] = [encoding_map[key] for key in condition_data['stimulus_keys']]
 
-        test_config['condition_groups'][condition.group_id] = condition_group_data
+        test_config['condition_groups'][group_id] = group_data[group_id]
 
         # make sure that condition_id is added to the conditions dict
-        test_config['conditions'].append(dict({'id': condition.id, 'group_id': condition.group_id}, **condition_data))
+        test_config['conditions'].append(dict({'id': c_id, 'group_id': group_id}, **condition_data))
     test_configurations.append(test_config)
 
+    if len(stimulus_encodings) > 0:
+        save_stimulus_encodings(participant_id, stimulus_encodings)
+
+    _test_configurations.put(key, test_configurations)
     return test_configurations
 
 
+_stimulus_encodings = LRUCache(app.config['STIMULUS_ENCODING_CACHE_SIZE'])
+
+
+def save_stimulus_encodings(participant_id, stimulus_encodings):
+    """
+    Save the encrypted stimulus keys of condition groups as presented to a participant (see `StimulusEncoding`).
+
+    Parameters
+    ----------
+    participant_id : int
+    stimulus_encodings : dict
+        Map from group id to a dict of the `decoding_map` and `filenames` (see `get_encoding_maps`)
+
+    Returns
+    -------
+    None
+    """
+    version = _design_version.get()
+    saved = dict((e.group_id, e) for e in StimulusEncoding.query.
+                 filter(StimulusEncoding.participant_id == participant_id,
+                        StimulusEncoding.group_id.in_(list(stimulus_encodings.keys()))))
+    for group_id, stimulus_encoding in stimulus_encodings.items():
+        data = json.dumps(stimulus_encoding)
+        if group_id in saved:
+            saved[group_id].data = data
+        else:
+            db.session.add(StimulusEncoding(participant_id, group_id, data))
+        _stimulus_encodings.put((participant_id, group_id, version), stimulus_encoding)
+    db.session.commit()
+
+
+def get_stimulus_encoding(participant_id, group_id):
+    """
+    Get the encrypted stimulus keys of a condition group as presented to a participant.
+
+    Parameters
+    ----------
+    participant_id : int
+    group_id : int
+
+    Returns
+    -------
+    stimulus_encoding : dict
+        The `decoding_map` and `filenames` (see `get_encoding_maps`). None if they weren't saved.
+    """
+    # keyed by the design version, as participant and group ids are reused when the design is reinserted
+    key = (participant_id, group_id, _design_version.get())
+    stimulus_encoding = _stimulus_encodings.get(key)
+    if stimulus_encoding is None:
+        saved = StimulusEncoding.query.filter_by(participant_id=participant_id, group_id=group_id).first()
+        if saved is None:
+            return None
+        stimulus_encoding = json.loads(saved.data)
+        _stimulus_encodings.put(key, stimulus_encoding)
+    return stimulus_encoding
+
+
 def get_encoding_maps(encrypted_audio_stimuli):
     """
     Build a stimulus key translation map from the `encypted_audio_stimuli`.
@@ -309,11 +1230,69 @@ def generate_comparison_pairs(condition_datas):
     return condition_datas
 
 
+# version, participant id, group id, index of the file in the group design, and encrypted stimulus number (0 for
+# references)
+AUDIO_URL_TOKEN_FORMAT = '>BIIHH'
+AUDIO_URL_TOKEN_VERSION = 2
+
+
+def _get_group_files(group_id):
+    """
+    Get the references and stimuli of a group, in the order of the design. Compact audio URL tokens refer to the files
+    by their index in this list.
+
+    Parameters
+    ----------
+    group_id : int
+
+    Returns
+    -------
+    files : list of tuple
+        (key, audio_file_path) of the references followed by the stimuli. None if there is no such group
+    """
+    version = _design_version.get()
+    files = _design_cache.get(('group_files', group_id, version))
+    if files is None:
+        group_data = _design_cache.get(('group', group_id, version))
+        if group_data is None:
+            group = Group.query.get(group_id)
+            if group is None:
+                return None
+            group_data = json.loads(group.data)
+            _design_cache.put(('group', group_id, version), group_data)
+        files = [tuple(f) for f in group_data['reference_files'] + group_data['stimulus_files']]
+        _design_cache.put(('group_files', group_id, version), files)
+    return files
+
+
+def get_audio_file_aliases():
+    """
+    Get the audio files of the design by their aliases (see `caqe.utilities.audio_file_alias`), which signed audio
+    redirects use instead of the file names (see `AUDIO_REDIRECT_ENABLED`).
+
+    Returns
+    -------
+    dict
+        Map from alias to audio file path
+    """
+    version = _design_version.get()
+    aliases = _design_cache.get(('audio_file_aliases', version))
+    if aliases is None:
+        aliases = {}
+        for group in Group.query.all():
+            group_data = json.loads(group.data)
+            for _, filename in group_data['reference_files'] + group_data['stimulus_files']:
+                aliases[utilities.audio_file_alias(filename, app.config['AUDIO_REDIRECT_SECRET_KEY'])] = filename
+        _design_cache.put(('audio_file_aliases', version), aliases)
+    return aliases
+
+
 def encrypt_audio_stimuli(audio_stimuli, participant_id, condition_group_id):
     """
     Reorder and encrypt the condition files. Do this by encoding each file as a special URL. One in which is an
     encrypted, serialized, dictionary. The dictionary contains, the participant_id (p_id), the condition_group_id
-    (g_id), the stimuli_id (s_id), and a encrypted stimuli_id (e_id)
+    (g_id), the stimuli_id (s_id), and a encrypted stimuli_id (e_id). With `COMPACT_AUDIO_URL_TOKENS`, the URL instead
+    holds a short encrypted token of the ids and the index of the file in the group (see `decode_audio_url_token`).
 
     Parameters
     ----------
@@ -329,14 +1308,25 @@ def encrypt_audio_stimuli(audio_stimuli, participant_id, condition_group_id):
         The first element of each duple is a key, the second is the encrypted audio_file_path
         For all non-references, the key should be of the form E[0-9+].
     """
-
-    def encode_url(url, _s_id, _e_id):
-        adict = {'s_id': _s_id,
-                 'p_id': participant_id,
-                 'g_id': condition_group_id,
-                 'e_id': _e_id,
-                 'URL': url}
-        return '/audio/' + utilities.encrypt_data(adict).decode('utf-8') + '.wav'
+    if app.config['COMPACT_AUDIO_URL_TOKENS']:
+        file_indices = dict((key, i) for i, (key, _) in enumerate(_get_group_files(condition_group_id)))
+
+        def encode_url(url, _s_id, _e_id):
+            e_num = 0 if _e_id == _s_id else int(_e_id[1:])
+            return '/audio/' + utilities.pack_encrypted_token(AUDIO_URL_TOKEN_FORMAT,
+                                                              AUDIO_URL_TOKEN_VERSION,
+                                                              participant_id,
+                                                              condition_group_id,
+                                                              file_indices[_s_id],
+                                                              e_num) + '.wav'
+    else:
+        def encode_url(url, _s_id, _e_id):
+            adict = {'s_id': _s_id,
+                     'p_id': participant_id,
+                     'g_id': condition_group_id,
+                     'e_id': _e_id,
+                     'URL': url}
+            return '/audio/' + utilities.encrypt_data(adict).decode('utf-8') + '.wav'
 
     audio_stimuli = copy.deepcopy(audio_stimuli)
 
@@ -353,29 +1343,106 @@ def encrypt_audio_stimuli(audio_stimuli, participant_id, condition_group_id):
     return references + non_references
 
 
+def decode_audio_url_token(token):
+    """
+    Decode the token of an audio URL made by `encrypt_audio_stimuli`, either compact or encrypted.
+
+    Parameters
+    ----------
+    token : str
+        The audio URL without '/audio/' and the file extension
+
+    Returns
+    -------
+    dict
+        The participant_id (p_id), the condition_group_id (g_id), the stimuli_id (s_id), the encrypted stimuli_id
+        (e_id) and the audio file path (URL)
+
+    Raises
+    ------
+    ValueError
+        If the token is invalid
+    """
+    try:
+        version, p_id, g_id, file_index, e_num = utilities.unpack_encrypted_token(AUDIO_URL_TOKEN_FORMAT, token)
+    except ValueError:
+        # an encrypted token
+        return utilities.decrypt_data(str(token))
+
+    files = _get_group_files(g_id)
+    if version != AUDIO_URL_TOKEN_VERSION or files is None or file_index >= len(files):
+        raise ValueError('Audio URL token refers to an unknown file')
+    s_id, url = files[file_index]
+    return {'s_id': s_id,
+            'p_id': p_id,
+            'g_id': g_id,
+            'e_id': s_id if e_num == 0 else 'E%d' % e_num,
+            'URL': url}
+
+
+_audio_url_tokens = LRUCache(app.config['AUDIO_URL_TOKEN_CACHE_SIZE'])
+
+
+def resolve_audio_url_token(token):
+    """
+    Decode the token of an audio URL, caching the result in the process. Browsers send many range requests for each
+    stimulus, so each token is decoded only once. The returned dict is shared, so don't modify it.
+
+    Parameters
+    ----------
+    token : str
+
+    Returns
+    -------
+    dict
+        See `decode_audio_url_token`
+
+    Raises
+    ------
+    ValueError
+        If the token is invalid
+    """
+    key = (token, _design_version.get())
+    audio_file_dict = _audio_url_tokens.get(key)
+    if audio_file_dict is None:
+        audio_file_dict = decode_audio_url_token(token)
+        _audio_url_tokens.put(key, audio_file_dict)
+    return audio_file_dict
+
+
 def _decode_url(encrypted_url):
     # remove /audio/
     encrypted_data = encrypted_url[7:]
     # remove .wav
     encrypted_data = encrypted_data[:-4]
-    return utilities.decrypt_data(str(encrypted_data))
+    return decode_audio_url_token(encrypted_data)
 
 
-def decrypt_audio_stimuli(condition_data):
+def decrypt_audio_stimuli(condition_data, participant_id=None):
     """
-    Decrypt the audio stimuli URLs from submitted trial data
+    Decrypt the audio stimuli URLs from submitted trial data. If the participant's stimulus encoding of the condition
+    group was saved when their evaluation was generated, it is used instead of decrypting the URLs.
 
     Parameters
     ----------
     condition_data: dict
         The condition data with encrypted audio URLs
+    participant_id: int, optional
 
     Returns
     -------
     trial_data: dict
     """
-    encrypted_filenames = condition_data['stimulusFiles']
-    _, decoding_map, decrypted_filenames = get_encoding_maps(encrypted_filenames)
+    stimulus_encoding = None
+    if participant_id is not None:
+        stimulus_encoding = get_stimulus_encoding(participant_id, int(condition_data['groupID']))
+
+    if stimulus_encoding is not None:
+        decoding_map = stimulus_encoding['decoding_map']
+        decrypted_filenames = stimulus_encoding['filenames']
+    else:
+        encrypted_filenames = condition_data['stimulusFiles']
+        _, decoding_map, decrypted_filenames = get_encoding_maps(encrypted_filenames)
 
     condition_data['stimulusFiles'] = decrypted_filenames
 
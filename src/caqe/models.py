@@ -4,9 +4,12 @@
 SQLAlchemy database models
 """
 import datetime
+import hashlib
 import uuid
 import logging
 
+import sqlalchemy
+
 from caqe import db
 from caqe import app
 
@@ -41,6 +44,11 @@ class Participant(db.Model):
         Post-test survey data in JSON
     hearing_response_estimation : str
         Hearing response estimation data in JSON
+    completed_condition_bits : bytes
+        Bitset of the ids of the conditions the participant has completed trials of (bit `i` of byte `i // 8` is
+        condition `i`). It is maintained as trials are saved and built from the participant's trials if it is None.
+    locked_test_id : int
+        The id of the Test of the participant's first trial (see `LIMIT_SUBJECT_TO_ONE_TASK_TYPE`)
     """
     id = db.Column(db.Integer, primary_key=True)
     ip_address = db.Column(db.String(45))
@@ -53,6 +61,8 @@ class Participant(db.Model):
     pre_test_survey = db.Column(db.Text, default=None)
     post_test_survey = db.Column(db.Text, default=None)
     hearing_response_estimation = db.Column(db.Text, default=None)
+    completed_condition_bits = db.Column(db.LargeBinary, default=None)
+    locked_test_id = db.Column(db.Integer, default=None)
     trials = db.relationship('Trial', backref='participant', lazy='dynamic')
 
     def __init__(self, platform, crowd_worker_id=None, ip_address=None):
@@ -104,6 +114,118 @@ class Participant(db.Model):
         self.hearing_test_attempts += 1
         self.passed_hearing_test = passed_hearing_test
 
+    def _load_completed_conditions(self):
+        """
+        Build `completed_condition_bits` and `locked_test_id` from the participant's trials if they have not been yet
+        (e.g. the participant predates them, and the columns were added by `upgrade_schema`).
+        """
+        if self.completed_condition_bits is not None:
+            return
+
+        bits = bytearray()
+        for condition_id, test_id in db.session.query(Trial.condition_id, Condition.test_id).join(Condition). \
+                filter(Trial.participant_id == self.id).order_by(Trial.id):
+            _set_bit(bits, condition_id)
+            if self.locked_test_id is None:
+                self.locked_test_id = test_id
+        self.completed_condition_bits = bytes(bits)
+
+    def has_completed_condition(self, condition_id):
+        """
+        Check if the participant has completed a trial of a condition
+
+        Parameters
+        ----------
+        condition_id : int
+
+        Returns
+        -------
+        bool
+        """
+        self._load_completed_conditions()
+        byte_index = condition_id >> 3
+        if byte_index >= len(self.completed_condition_bits):
+            return False
+        return bool(self.completed_condition_bits[byte_index] & (1 << (condition_id & 7)))
+
+    def get_completed_condition_ids(self):
+        """
+        Get the ids of the conditions the participant has completed trials of
+
+        Returns
+        -------
+        list of int
+        """
+        self._load_completed_conditions()
+        return [byte_index * 8 + bit for byte_index, byte in enumerate(self.completed_condition_bits) if byte
+                for bit in range(8) if byte & (1 << bit)]
+
+    def add_completed_condition(self, condition_id, test_id):
+        """
+        Record that the participant completed a trial of a condition
+
+        Parameters
+        ----------
+        condition_id : int
+        test_id : int
+            The id of the Test of the condition
+
+        Returns
+        -------
+        None
+        """
+        self._load_completed_conditions()
+        bits = bytearray(self.completed_condition_bits)
+        _set_bit(bits, condition_id)
+        self.completed_condition_bits = bytes(bits)
+        if self.locked_test_id is None:
+            self.locked_test_id = test_id
+
+    def get_locked_test_id(self):
+        """
+        Get the id of the Test the participant is limited to (see `LIMIT_SUBJECT_TO_ONE_TASK_TYPE`)
+
+        Returns
+        -------
+        int
+            None if the participant has not completed any trials
+        """
+        self._load_completed_conditions()
+        return self.locked_test_id
+
+
+def _set_bit(bits, index):
+    """
+    Set bit `index` of a bytearray bitset, growing it if needed.
+    """
+    byte_index = index >> 3
+    if byte_index >= len(bits):
+        bits.extend(bytes(byte_index + 1 - len(bits)))
+    bits[byte_index] |= 1 << (index & 7)
+
+
+class ConfigBlob(db.Model):
+    """
+    Test configuration shared by many tests (e.g. the application configuration), stored once and addressed by the
+    hash of its content.
+
+    Attributes
+    ----------
+    hash : str
+        Primary key. Hex-encoded SHA-256 digest of `data`
+    data : str
+        JSON-encoded string of configuration variables
+    """
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text)
+
+    def __init__(self, data):
+        self.hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        self.data = data
+
+    def __repr__(self):
+        return "<ConfigBlob hash=%r>" % self.hash
+
 
 class Test(db.Model):
     """
@@ -114,17 +236,23 @@ class Test(db.Model):
     id: int
         Primary key
     data: str
-        JSON-encoded string of formatted test variables
+        JSON-encoded string of formatted test variables. If `config_hash` is set, only the variables that override the
+        shared configuration.
+    config_hash: str, optional
+        Foreign key to the ConfigBlob the test variables are merged into. Tests inserted before configurations were
+        shared have none, and `data` holds all of their variables.
     """
     id = db.Column(db.Integer, primary_key=True)
     data = db.Column(db.Text)
+    config_hash = db.Column(db.String(64), db.ForeignKey('config_blob.hash'))
     conditions = db.relationship('Condition', backref='test', lazy='dynamic')
 
-    def __init__(self, data):
+    def __init__(self, data, config_hash=None):
         self.data = data
+        self.config_hash = config_hash
 
     def __repr__(self):
-        return "<Test id=%r, data=%r>" % (self.id, self.data)
+        return "<Test id=%r, config_hash=%r, data=%r>" % (self.id, self.config_hash, self.data)
 
 
 class Group(db.Model):
@@ -178,6 +306,181 @@ class Condition(db.Model):
         return "<Condition id=%r, test_id=%r, group_id=%r, data=%r>" % (self.id, self.test_id, self.group_id, self.data)
 
 
+class DesignVersion(db.Model):
+    """
+    A stamp of the experimental design, i.e. the tests, groups and conditions. A new stamp is inserted every time the
+    design is inserted, so that processes that cache the decoded design know to discard it.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    version : str
+        Unique stamp of the design
+    created : datetime.datetime
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.String(32))
+    created = db.Column(db.DateTime)
+
+    def __init__(self):
+        self.version = uuid.uuid4().hex
+        self.created = datetime.datetime.now()
+
+    def __repr__(self):
+        return "<DesignVersion id=%r, version=%r, created=%r>" % (self.id, self.version, self.created)
+
+
+class ConditionCount(db.Model):
+    """
+    The number of completed trials of a condition. This is maintained incrementally as trials are saved so that
+    condition availability can be determined without aggregating the Trial table. It can be recomputed from the Trial
+    table with `caqe.experiment.rebuild_condition_counts`.
+
+    Attributes
+    ----------
+    condition_id : int
+        Primary key and foreign key to the Condition being counted
+    passed_count : int
+        The number of trials completed by participants that had passed the hearing test
+    failed_count : int
+        The number of trials completed by participants that had not passed the hearing test
+    reserved_count : int
+        The number of ConditionReservations currently held on the condition
+    rating_statistics : str, optional
+        JSON-encoded running statistics of the ratings of each stimulus in trials by participants that passed the
+        hearing test (see `caqe.allocation.update_rating_statistics`)
+    rating_ci_half_width : float, optional
+        The widest confidence interval half-width of the mean stimulus ratings, None until every stimulus has two
+        ratings
+    finished : bool
+        The ratings of the condition met the early stopping rule (see `EARLY_STOPPING_ENABLED`), so it is no longer
+        available
+    """
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'), primary_key=True)
+    passed_count = db.Column(db.Integer, default=0, nullable=False)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    reserved_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_statistics = db.Column(db.Text, default=None)
+    rating_ci_half_width = db.Column(db.Float, default=None)
+    finished = db.Column(db.Boolean, default=False, nullable=False)
+    condition = db.relationship('Condition', backref=db.backref('count', uselist=False))
+
+    def __init__(self, condition_id, passed_count=0, failed_count=0, reserved_count=0):
+        self.condition_id = condition_id
+        self.passed_count = passed_count
+        self.failed_count = failed_count
+        self.reserved_count = reserved_count
+        self.finished = False
+
+    def __repr__(self):
+        return "<ConditionCount condition_id=%r, passed_count=%r, failed_count=%r, reserved_count=%r>" % \
+               (self.condition_id, self.passed_count, self.failed_count, self.reserved_count)
+
+
+class ConditionReservation(db.Model):
+    """
+    A trial slot of a condition held for a participant between assignment and submission, so that concurrent
+    participants are not assigned more trials than `TRIALS_PER_CONDITION`. Used by the 'query'
+    `CONDITION_ASSIGNMENT_ENGINE` (the 'ticket' engine holds its ConditionTickets instead).
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    condition_id : int
+        Foreign key to the reserved Condition
+    participant_id : int
+        Foreign key to the Participant holding the reservation
+    expires_at : DateTime
+        The DateTime after which the reservation is released
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'))
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), index=True)
+    expires_at = db.Column(db.DateTime, index=True)
+
+    def __init__(self, condition_id, participant_id, expires_at):
+        self.condition_id = condition_id
+        self.participant_id = participant_id
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return "<ConditionReservation id=%r, condition_id=%r, participant_id=%r, expires_at=%r>" % \
+               (self.id, self.condition_id, self.participant_id, self.expires_at)
+
+
+class ConditionTicket(db.Model):
+    """
+    A remaining trial slot of a condition. `TRIALS_PER_CONDITION` tickets are created per condition, a ticket is claimed
+    by a participant for `CONDITION_RESERVATION_TTL_SECONDS` when the condition is assigned to them, and it is consumed
+    when they complete a trial of the condition having passed the hearing test. Used by the 'ticket'
+    `CONDITION_ASSIGNMENT_ENGINE`.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    condition_id : int
+        Foreign key to the Condition of the slot
+    group_id : int
+        Foreign key to the Group of the condition (denormalized for assignment)
+    test_id : int
+        Foreign key to the Test of the condition (denormalized for assignment)
+    participant_id : int, optional
+        Foreign key to the Participant that has claimed the ticket
+    expires_at : DateTime, optional
+        The DateTime after which a claim is no longer valid and the ticket may be claimed by another participant
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'), index=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), index=True)
+    test_id = db.Column(db.Integer, db.ForeignKey('test.id'))
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), index=True)
+    expires_at = db.Column(db.DateTime)
+
+    def __init__(self, condition_id, group_id, test_id):
+        self.condition_id = condition_id
+        self.group_id = group_id
+        self.test_id = test_id
+
+    def __repr__(self):
+        return "<ConditionTicket id=%r, condition_id=%r, group_id=%r, participant_id=%r, expires_at=%r>" % \
+               (self.id, self.condition_id, self.group_id, self.participant_id, self.expires_at)
+
+
+class StimulusEncoding(db.Model):
+    """
+    The encrypted stimulus keys (E1, E2, ...) of a condition group as presented to a participant, saved when their
+    evaluation is generated so that submitted ratings can be decoded without decrypting the stimulus URLs.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    participant_id : int
+        Foreign key to the Participant
+    group_id : int
+        Foreign key to the Group
+    data : str
+        JSON-encoded dict of the `decoding_map` (encrypted to unencrypted stimulus keys) and the `filenames`
+        (unencrypted stimulus key to audio file path)
+    """
+    __table_args__ = (db.UniqueConstraint('participant_id', 'group_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'))
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'))
+    data = db.Column(db.Text)
+
+    def __init__(self, participant_id, group_id, data):
+        self.participant_id = participant_id
+        self.group_id = group_id
+        self.data = data
+
+    def __repr__(self):
+        return "<StimulusEncoding id=%r, participant_id=%r, group_id=%r>" % (self.id, self.participant_id, self.group_id)
+
+
 class Trial(db.Model):
     """
     A trial in an experiment
@@ -221,3 +524,39 @@ class Trial(db.Model):
                 self.condition_id,
                 self.participant_passed_hearing_test,
                 self.datetime_completed)
+
+
+def upgrade_schema():
+    """
+    Upgrade the schema of a database created by an earlier version: create the missing tables, and add the missing
+    columns of existing tables with ``ALTER TABLE ... ADD COLUMN``. `db.create_all` alone never alters existing
+    tables. Added columns get their default value (if it is a constant) in existing rows, but no foreign key or NOT NULL
+    constraints.
+
+    Returns
+    -------
+    added_columns : list of str
+        The added columns, as 'table.column'
+    """
+    db.create_all()
+
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
+    inspector = sqlalchemy.inspect(db.engine)
+    added_columns = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = set(c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (quote(table.name),
+                                                           quote(column.name),
+                                                           column.type.compile(dialect=dialect))
+                if column.default is not None and column.default.is_scalar:
+                    ddl += ' DEFAULT %s' % sqlalchemy.literal(column.default.arg, column.type). \
+                        compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+                connection.execute(sqlalchemy.text(ddl))
+                added_columns.append('%s.%s' % (table.name, column.name))
+                logger.info('Added column %s.%s' % (table.name, column.name))
+    return added_columns
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Server-side sessions. The session cookie holds only a random session id, and the session data is kept in a
+`SessionStore` and loaded only when a view uses the session (see `SESSION_BACKEND`).
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+
+
+class SessionStore(object):
+    """
+    Interface of a store of session data. Implement this to keep sessions in e.g. an external key-value store, and set
+    `SESSION_BACKEND` to an instance of it.
+    """
+    def load(self, sid):
+        """
+        Load the data of a session.
+
+        Parameters
+        ----------
+        sid : str
+            Session id
+
+        Returns
+        -------
+        str
+            The serialized session data. None if there is no such session or it has expired.
+        """
+        raise NotImplementedError()
+
+    def save(self, sid, data, expires_at):
+        """
+        Save the data of a session.
+
+        Parameters
+        ----------
+        sid : str
+            Session id
+        data : str
+            The serialized session data
+        expires_at : float
+            Unix time after which the session may be discarded
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        """
+        Delete a session.
+
+        Parameters
+        ----------
+        sid : str
+            Session id
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps sessions in a local SQLite database file, which the worker processes of a host share.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database file
+    cleanup_interval : float
+        Minimum number of seconds between deletions of expired sessions
+    """
+    def __init__(self, path, cleanup_interval=60. * 60):
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self._local = threading.local()
+        self._last_cleanup = 0.
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS session '
+                               '(sid TEXT PRIMARY KEY, data TEXT, expires_at REAL)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10.)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def load(self, sid):
+        row = self._connection().execute('SELECT data FROM session WHERE sid = ? AND expires_at > ?',
+                                         (sid, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, sid, data, expires_at):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO session (sid, data, expires_at) VALUES (?, ?, ?)',
+                               (sid, data, expires_at))
+            if time.time() - self._last_cleanup > self.cleanup_interval:
+                self._last_cleanup = time.time()
+                connection.execute('DELETE FROM session WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+
+class ServerSideSession(MutableMapping, SessionMixin):
+    """
+    A session whose data is loaded from the `SessionStore` the first time it is used.
+
+    Parameters
+    ----------
+    store : SessionStore
+    sid : str, optional
+        Session id from the cookie. None for a new session.
+    """
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            serialized = self.store.load(self.sid) if self.sid is not None else None
+            if serialized is None:
+                # expired, deleted or new
+                self.sid = None
+                self.new = True
+                self._data = {}
+            else:
+                self._data = session_json_serializer.loads(serialized)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface that keeps session data in a `SessionStore`.
+
+    Parameters
+    ----------
+    store : SessionStore
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        return ServerSideSession(self.store, request.cookies.get(app.session_cookie_name))
+
+    def save_session(self, app, session, response):
+        # the session wasn't used by the view
+        if not session.loaded or not session.modified:
+            return
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if len(session) == 0:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if session.sid is None:
+            session.sid = os.urandom(32).hex()
+        self.store.save(session.sid,
+                        session_json_serializer.dumps(dict(session.data)),
+                        time.time() + app.permanent_session_lifetime.total_seconds())
+        response.set_cookie(app.session_cookie_name,
+                            session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app))
+
+
+def create_session_interface(config):
+    """
+    Create the session interface selected by `SESSION_BACKEND`.
+
+    Parameters
+    ----------
+    config : flask.Config
+
+    Returns
+    -------
+    flask.sessions.SessionInterface
+        None for Flask's default signed cookie sessions
+    """
+    backend = config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return None
+    elif backend == 'sqlite':
+        return ServerSideSessionInterface(SQLiteSessionStore(config['SESSION_SQLITE_PATH']))
+    elif isinstance(backend, SessionStore):
+        return ServerSideSessionInterface(backend)
+    raise ValueError('Unknown SESSION_BACKEND %r' % backend)
@@ -204,6 +204,38 @@ AudioGroup.prototype.muteAll = function () {
 };
 
 
+/**
+ * Load the participant's conditions and stimuli into the configuration of a page shell (see
+ * EVALUATION_CONFIG_API_ENABLED), then call `onLoaded`
+ * @param {string} configURL - URL of the JSON configuration
+ * @param {Object} config - The configuration inlined in the page shell, which is completed in place
+ * @param {function} onLoaded - Called with the completed configuration
+ */
+function loadEvaluationConfig(configURL, config, onLoaded) {
+    $.getJSON(configURL)
+        .done(function (data) {
+            var i;
+            TEST_COMPLETE_REDIRECT_URL = data.testCompleteRedirectURL;
+            SUBMISSION_URL = data.submissionURL;
+            PARTICIPANT_ID = data.participantID;
+            config.conditionGroups = data.conditionGroups;
+            config.conditions = data.conditions;
+            for (i = 0; i < config.conditions.length; i++) {
+                // inlined configurations render missing instructions as 'None'
+                if (config.conditions[i]['evaluation_instructions_html'] === null) {
+                    config.conditions[i]['evaluation_instructions_html'] = 'None';
+                }
+            }
+            $(data.firstEvaluation ? '.subsequent-evaluation' : '.first-evaluation').remove();
+            onLoaded(config);
+        })
+        .fail(function () {
+            $('#error p').html('The evaluation could not be loaded. Please reload the page.');
+            $('#error').removeClass('hidden');
+        });
+}
+
+
 /**
  * Manages the evaluation task
  * @constructor
@@ -4,7 +4,11 @@
 Utility functions
 """
 import base64
+import hashlib
+import hmac
 import json
+import os
+import struct
 
 from itsdangerous import URLSafeSerializer
 from Crypto.Cipher import AES
@@ -86,3 +90,143 @@ def decrypt_data(encrypted_data):
     datas = datas.rstrip(b'{')
     data = json.loads(datas)
     return data
+
+
+# bytes of the HMAC kept in packed tokens
+TOKEN_MAC_SIZE = 8
+
+
+def _token_key(purpose):
+    # separate keys for the encryption and the authentication of tokens, derived from the secret key
+    key = app.secret_key if isinstance(app.secret_key, bytes) else app.secret_key.encode('utf-8')
+    return hmac.new(key, purpose, hashlib.sha256).digest()
+
+
+def _token_mac(ciphertext):
+    return hmac.new(_token_key(b'token authentication'), ciphertext, hashlib.sha256).digest()[:TOKEN_MAC_SIZE]
+
+
+def _token_cipher():
+    return AES.new(_token_key(b'token encryption')[:16], AES.MODE_ECB)
+
+
+def pack_encrypted_token(fmt, *values):
+    """
+    Pack values into a short, URL-safe token. The values are zero-padded to a single AES block, encrypted, and
+    authenticated with a truncated HMAC of the ciphertext, so they are both hidden and protected from tampering.
+
+    Parameters
+    ----------
+    fmt : str
+        `struct` format of the values, at most `AES.block_size` bytes
+    values : tuple
+
+    Returns
+    -------
+    str
+        URL-safe base64 token, without padding
+    """
+    payload = struct.pack(fmt, *values)
+    if len(payload) > AES.block_size:
+        raise ValueError('Token values must fit in a single AES block')
+    ciphertext = _token_cipher().encrypt(payload + b'\0' * (AES.block_size - len(payload)))
+    return base64.urlsafe_b64encode(ciphertext + _token_mac(ciphertext)).decode('ascii').rstrip('=')
+
+
+def unpack_encrypted_token(fmt, token):
+    """
+    Verify, decrypt and unpack a token made with `pack_encrypted_token`.
+
+    Parameters
+    ----------
+    fmt : str
+        `struct` format of the values
+    token : str
+
+    Returns
+    -------
+    values : tuple
+
+    Raises
+    ------
+    ValueError
+        If the token is malformed or its HMAC doesn't match
+    """
+    if len(token) != len(base64.urlsafe_b64encode(b'\0' * (AES.block_size + TOKEN_MAC_SIZE)).rstrip(b'=')):
+        raise ValueError('Token has the wrong length')
+    try:
+        data = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+    except TypeError as e:
+        raise ValueError(str(e))
+    ciphertext, mac = data[:AES.block_size], data[AES.block_size:]
+    if not hmac.compare_digest(mac, _token_mac(ciphertext)):
+        raise ValueError('Token has an invalid signature')
+    payload = _token_cipher().decrypt(ciphertext)
+    return struct.unpack(fmt, payload[:struct.calcsize(fmt)])
+
+
+def audio_file_alias(filename, key=None):
+    """
+    An opaque name of an audio file, which doesn't reveal the stimulus: the URL-safe base64 HMAC-SHA256 of its path,
+    with its extension.
+
+    Parameters
+    ----------
+    filename : str
+        Path relative to the `AUDIO_FILE_DIRECTORY`
+    key : str, optional
+        If None, the app's secret key.
+
+    Returns
+    -------
+    str
+    """
+    key = key if key is not None else app.secret_key
+    key = key if isinstance(key, bytes) else key.encode('utf-8')
+    digest = hmac.new(key, b'audio file alias\n' + filename.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode('ascii') + os.path.splitext(filename)[1]
+
+
+def sign_url_path(path, expires, key=None):
+    """
+    Sign a URL path and expiry time with HMAC-SHA256, for short-lived URLs that a static file server or CDN can verify
+    with the same key.
+
+    Parameters
+    ----------
+    path : str
+        Unquoted URL path, e.g. '/audio/file 1.wav'
+    expires : int
+        Unix time after which the URL is invalid
+    key : str, optional
+        Signing key. If None, the app's secret key.
+
+    Returns
+    -------
+    str
+        URL-safe base64 signature, without padding
+    """
+    key = key if key is not None else app.secret_key
+    key = key if isinstance(key, bytes) else key.encode('utf-8')
+    message = ('%s\n%d' % (path, expires)).encode('utf-8')
+    return base64.urlsafe_b64encode(hmac.new(key, message, hashlib.sha256).digest()).decode('ascii').rstrip('=')
+
+
+def verify_url_path_signature(path, expires, signature, now, key=None):
+    """
+    Check a signature made with `sign_url_path`, and that the URL hasn't expired.
+
+    Parameters
+    ----------
+    path : str
+    expires : int
+    signature : str
+    now : float
+        The current Unix time
+    key : str, optional
+
+    Returns
+    -------
+    bool
+    """
+    return now <= expires and hmac.compare_digest(str(signature), sign_url_path(path, expires, key))
@@ -4,6 +4,7 @@
 URL route handlers
 """
 
+import hashlib
 import json
 import logging
 import random
@@ -13,19 +14,26 @@ import functools
 import os
 import mimetypes
 import re
-from urllib.request import urlopen
-import io
+import threading
+import time
+
+import requests
 
 from flask import request, render_template, flash, redirect, session, make_response, \
-    safe_join, url_for, send_file, Response
+    safe_join, url_for, send_file, Response, abort
+
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 
+from caqe import compression
 from caqe import experiment
 
 from caqe import app
 from caqe import db
-from .models import Participant, Trial, Condition
+from .models import Participant, Trial, Condition, ConditionCount
 import caqe.utilities as utilities
 import caqe.configuration as configuration
+from caqe.caching import DiskCache, LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -33,95 +41,389 @@ logger = logging.getLogger(__name__)
 @app.after_request
 def after_request(response):
     response.headers.add('Accept-Ranges', 'bytes')
-    return response
+    if getattr(session, 'sid', None) is not None and session.modified:
+        # the participant or condition groups may have changed
+        _audio_authorizations.put(session.sid, None)
+    return compression.compress_response(response)
 
 
-def send_file_partial(path):
+# serve precompressed static files where they exist
+app.view_functions['static'] = compression.send_static_file
+
+
+# size of the chunks in which byte ranges that can't be handed to the server's file wrapper are read
+FILE_CHUNK_SIZE = 64 * 1024
+
+# the most ranges served in one multipart/byteranges response, more are coalesced
+MAX_BYTE_RANGES = 16
+
+
+def parse_byte_ranges(range_header, size):
     """
-    Simple wrapper around send_file which handles HTTP 206 Partial Content
-    (byte ranges)
+    Parse a Range header into the byte ranges of a file to send. Suffix ranges (``bytes=-500``) and open ended ranges
+    (``bytes=500-``) are resolved against `size`, ends past the end of the file are truncated, and overlapping or
+    adjacent ranges are merged.
+
+    Parameters
+    ----------
+    range_header : str
+    size : int
+        File size in bytes
+
+    Returns
+    -------
+    ranges : list of (int, int)
+        (start, stop) byte offsets, stop exclusive. An empty list if no range is satisfiable, and None if the header
+        is malformed (in which case it is ignored and the whole file sent).
+    """
+    units, _, range_set = range_header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for byte_range in range_set.split(','):
+        m = re.match(r'^\s*(\d*)\s*-\s*(\d*)\s*$', byte_range)
+        if m is None or m.group(1) == m.group(2) == '':
+            return None
+        if m.group(1) == '':
+            # suffix range, the last n bytes
+            start, stop = max(size - int(m.group(2)), 0), size
+        else:
+            start = int(m.group(1))
+            if m.group(2) != '' and int(m.group(2)) < start:
+                return None
+            stop = size if m.group(2) == '' else min(int(m.group(2)) + 1, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    ranges.sort()
+    merged = ranges[:1]
+    for start, stop in ranges[1:]:
+        if start <= merged[-1][1] or len(merged) >= MAX_BYTE_RANGES:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def iter_file_range(path, start, stop, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Read a byte range of a file in chunks.
 
     Parameters
     ----------
     path : str
+    start : int
+    stop : int
+        Exclusive
+    chunk_size : int
 
-    Notes
-    -----
-    This is code is from https://gist.github.com/lizhiwei/7885684
+    Returns
+    -------
+    generator of bytes
     """
-    range_header = request.headers.get('Range', None)
-    if not range_header: return send_file(path)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
-    size = os.path.getsize(path)
 
-    byte1, byte2 = 0, None
+def send_partial(size, mimetype, etag, last_modified, read_range):
+    """
+    Send a resource, handling HTTP 206 Partial Content (byte ranges). Supports suffix ranges, multiple ranges (as
+    multipart/byteranges), If-Range, and conditional requests against a strong ETag and Last-Modified. Unsatisfiable
+    ranges get a 416 response.
 
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
+    Parameters
+    ----------
+    size : int
+        Size of the resource in bytes
+    mimetype : str
+    etag : str
+        Strong ETag of the resource
+    last_modified : datetime.datetime
+    read_range : callable
+        Function of (start, stop) byte offsets (stop exclusive) that returns an iterable of the bytes of the range
 
-    if g[0]:
-        byte1 = int(g[0])
-    if g[1]:
-        byte2 = int(g[1])
+    Returns
+    -------
+    flask.Response
+    """
+    def add_validators(rv):
+        rv.set_etag(etag)
+        rv.last_modified = last_modified
+        return rv
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return add_validators(Response(status=304))
 
-    data = None
+    ranges = None
+    range_header = request.headers.get('Range', None)
+    if range_header and request.method in ('GET', 'HEAD'):
+        # If-Range: only send the ranges if the client's copy is still current
+        if_range = request.if_range
+        if if_range.etag is None and if_range.date is None \
+                or if_range.etag == etag \
+                or if_range.date is not None and if_range.date == last_modified:
+            ranges = parse_byte_ranges(range_header, size)
+
+    if ranges is None:
+        rv = Response(read_range(0, size), mimetype=mimetype, direct_passthrough=True)
+        rv.content_length = size
+        return add_validators(rv)
+
+    if len(ranges) == 0:
+        rv = Response(status=416)
+        rv.headers['Content-Range'] = 'bytes */{0}'.format(size)
+        return add_validators(rv)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv = Response(read_range(start, stop), 206, mimetype=mimetype, direct_passthrough=True)
+        rv.content_length = stop - start
+        rv.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)
+        return add_validators(rv)
+
+    boundary = os.urandom(16).hex()
+    part_headers = ['--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'
+                    .format(boundary, mimetype, start, stop - 1, size).encode('latin-1') for start, stop in ranges]
+    closing = '--{0}--\r\n'.format(boundary).encode('latin-1')
+
+    def generate():
+        for part_header, (start, stop) in zip(part_headers, ranges):
+            yield part_header
+            body = read_range(start, stop)
+            try:
+                for chunk in body:
+                    yield chunk
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            yield b'\r\n'
+        yield closing
+
+    rv = Response(generate(), 206, mimetype='multipart/byteranges; boundary=' + boundary, direct_passthrough=True)
+    rv.content_length = sum(len(h) + stop - start + 2 for h, (start, stop) in zip(part_headers, ranges)) \
+        + len(closing)
+    return add_validators(rv)
 
-    with open(path, 'rb') as f:
-        f.seek(byte1)
-        data = f.read(length)
 
-    rv = Response(data,
-                  206,
-                  mimetype=mimetypes.guess_type(path)[0],
-                  direct_passthrough=True)
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
+def send_file_partial(path):
+    """
+    Send a file, handling HTTP 206 Partial Content (byte ranges) with `send_partial`.
 
-    return rv
+    The file is never read into memory as a whole. The whole file, and ranges that extend to the end of the file
+    (e.g. ``bytes=0-``, which browsers send to start audio playback), are handed to the WSGI server's
+    ``wsgi.file_wrapper`` (which may use sendfile); other ranges are streamed in `FILE_CHUNK_SIZE` chunks.
 
+    Parameters
+    ----------
+    path : str
 
-def send_file_partial_hack(path):
+    Returns
+    -------
+    flask.Response
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        abort(404)
+    size = stat.st_size
+    # multipart bodies are read after the request context is gone
+    environ = request.environ
+
+    def read_range(start, stop):
+        if stop == size:
+            f = open(path, 'rb')
+            f.seek(start)
+            return wrap_file(environ, f)
+        return iter_file_range(path, start, stop)
+
+    return send_partial(size,
+                        mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                        '%x-%x-%x' % (int(stat.st_mtime * 1e6), size, stat.st_ino),
+                        datetime.datetime.utcfromtimestamp(int(stat.st_mtime)),
+                        read_range)
+
+
+def send_audio_file(path):
+    """
+    Send a local audio file, through the front proxy if `AUDIO_OFFLOAD` is set, or with `send_file_partial` otherwise.
 
-    range_header = request.headers.get('Range', None)
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    flask.Response
+    """
+    offload = app.config['AUDIO_OFFLOAD']
+    if offload is None:
+        return send_file_partial(path)
+
+    path = os.path.abspath(path)
+    if not os.path.isfile(path):
+        abort(404)
+
+    rv = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    if offload == 'x-sendfile':
+        rv.headers['X-Sendfile'] = path
+    elif offload == 'x-accel-redirect':
+        root = app.config['AUDIO_OFFLOAD_ROOT'] or os.path.dirname(app.root_path)
+        relative_path = os.path.relpath(path, root)
+        if relative_path.startswith(os.pardir):
+            logger.warning('%s is outside of AUDIO_OFFLOAD_ROOT, sending it without offloading.' % path)
+            return send_file_partial(path)
+        rv.headers['X-Accel-Redirect'] = app.config['AUDIO_OFFLOAD_LOCATION'].rstrip('/') + '/' + \
+            urlparse.quote(relative_path.replace(os.sep, '/'))
+    else:
+        raise ValueError('Unknown AUDIO_OFFLOAD %r' % offload)
+    return rv
 
-    f = urlopen(path)
 
-    size = int(f.info()['Content-Length'])
+# request headers forwarded to the external file host
+FORWARDED_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
 
-    byte1, byte2 = 0, None
+# response headers of the external file host passed on to the client
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag',
+                              'Last-Modified')
 
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
+_external_file_host_session = None
+_external_file_host_session_lock = threading.Lock()
 
-    if g[0]:
-        byte1 = int(g[0])
-    if g[1]:
-        byte2 = int(g[1])
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1
+def get_external_file_host_session():
+    """
+    Get the HTTP session of this process for requests to the external file host, which keeps a pool of keep-alive
+    connections (see `EXTERNAL_FILE_HOST_POOL_SIZE`).
 
-    data = None
+    Returns
+    -------
+    requests.Session
+    """
+    global _external_file_host_session
+    with _external_file_host_session_lock:
+        if _external_file_host_session is None:
+            pool_size = app.config['EXTERNAL_FILE_HOST_POOL_SIZE']
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+            http = requests.Session()
+            http.mount('http://', adapter)
+            http.mount('https://', adapter)
+            _external_file_host_session = http
+        return _external_file_host_session
+
+
+def send_external_file_partial(url):
+    """
+    Send a file from the external file host (see `EXTERNAL_FILE_HOST`). The client's Range and conditional request
+    headers are forwarded, so only the requested bytes are fetched, and the upstream response is streamed back in
+    `FILE_CHUNK_SIZE` chunks.
 
-    byte = io.BytesIO(f.read())
-    f.close()
-    byte.seek(byte1)
-    data = byte.read(length)
-    byte.close()
+    Parameters
+    ----------
+    url : str
 
-    rv = Response(data,
-                  206,
-                  mimetype=mimetypes.guess_type(path)[0],
+    Returns
+    -------
+    flask.Response
+    """
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    # content-codings would make the byte ranges ambiguous
+    headers['Accept-Encoding'] = 'identity'
+
+    try:
+        upstream = get_external_file_host_session().get(url,
+                                                        headers=headers,
+                                                        stream=True,
+                                                        timeout=app.config['EXTERNAL_FILE_HOST_TIMEOUT'])
+    except requests.exceptions.Timeout:
+        logger.exception('Timed out fetching %s from the external file host.' % url)
+        abort(504)
+    except requests.exceptions.RequestException:
+        logger.exception('Error fetching %s from the external file host.' % url)
+        abort(502)
+
+    if upstream.status_code not in (200, 206, 304, 416):
+        upstream.close()
+        logger.error('External file host returned %d for %s.' % (upstream.status_code, url))
+        abort(404 if upstream.status_code in (403, 404, 410) else 502)
+
+    rv = Response(upstream.raw.stream(FILE_CHUNK_SIZE, decode_content=False),
+                  upstream.status_code,
                   direct_passthrough=True)
-
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
+    for name in FORWARDED_RESPONSE_HEADERS:
+        if name in upstream.headers:
+            rv.headers[name] = upstream.headers[name]
+    if 'Content-Type' not in upstream.headers:
+        rv.mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+    # release the connection back to the pool
+    rv.call_on_close(upstream.close)
     return rv
 
 
+_external_file_cache = None
+_external_file_cache_lock = threading.Lock()
+
+
+def get_external_file_cache():
+    """
+    Get the disk cache of the files of the external file host (see `EXTERNAL_FILE_CACHE_ENABLED`).
+
+    Returns
+    -------
+    caqe.caching.DiskCache
+    """
+    global _external_file_cache
+    with _external_file_cache_lock:
+        if _external_file_cache is None:
+            _external_file_cache = DiskCache(app.config['EXTERNAL_FILE_CACHE_DIRECTORY'],
+                                             app.config['EXTERNAL_FILE_CACHE_MAX_SIZE'])
+        return _external_file_cache
+
+
+def cache_external_file(url):
+    """
+    Get the path of the locally cached copy of a file of the external file host, downloading it if it isn't cached.
+
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    str
+        None if the file couldn't be cached, or is being cached by another process
+    """
+    cache = get_external_file_cache()
+    path = cache.get(url)
+    if path is not None:
+        return path
+
+    def fetch():
+        upstream = get_external_file_host_session().get(url,
+                                                        headers={'Accept-Encoding': 'identity'},
+                                                        stream=True,
+                                                        timeout=app.config['EXTERNAL_FILE_HOST_TIMEOUT'])
+        try:
+            upstream.raise_for_status()
+            for chunk in upstream.iter_content(FILE_CHUNK_SIZE):
+                yield chunk
+        finally:
+            upstream.close()
+
+    try:
+        return cache.fill(url, fetch)
+    except (requests.exceptions.RequestException, OSError):
+        logger.exception('Error caching %s from the external file host.' % url)
+        return None
+
+
 def nocache(view):
     """
     No cache decorator. Puts no cache directives in header to avoid caching of endpoint.
@@ -133,16 +435,30 @@ def nocache(view):
 
     @functools.wraps(view)
     def no_cache(*args, **kwargs):
-        response = make_response(view(*args, **kwargs))
-        response.headers['Last-Modified'] = datetime.datetime.now()
-        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '-1'
-        return response
+        return set_nocache_headers(make_response(view(*args, **kwargs)))
 
     return functools.update_wrapper(no_cache, view)
 
 
+def set_nocache_headers(response):
+    """
+    Put no cache directives in the header of a response (see `nocache`).
+
+    Parameters
+    ----------
+    response : flask.Response
+
+    Returns
+    -------
+    flask.Response
+    """
+    response.headers['Last-Modified'] = datetime.datetime.now()
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '-1'
+    return response
+
+
 def strip_query_from_url(url):
     """
     Return the a URL without the query, which may be simply used for cache busting.
@@ -233,6 +549,41 @@ def page_not_found(e):
     return render_template('sorry.html', message='404 Page Not Found -- Sorry, that page doesn\'t exist.'), 404
 
 
+# (participant id, condition group ids, time cached) of server-side sessions, by session id
+_audio_authorizations = LRUCache(app.config['AUDIO_AUTHORIZATION_CACHE_SIZE'])
+
+
+def authorize_audio(audio_file_dict):
+    """
+    Check that an audio file belongs to the participant of the session and one of their condition groups. With
+    server-side sessions (see `SESSION_BACKEND`), the participant and groups of a session are cached for
+    `AUDIO_AUTHORIZATION_CACHE_SECONDS`, so that the range requests of a stimulus don't each load the session.
+
+    Parameters
+    ----------
+    audio_file_dict : dict
+        See `caqe.experiment.decode_audio_url_token`
+
+    Raises
+    ------
+    AssertionError
+        If the audio file belongs to another participant or condition group
+    """
+    # the session id from the cookie, without loading the session
+    sid = getattr(session, 'sid', None)
+    authorization = _audio_authorizations.get(sid) if sid is not None else None
+    if authorization is None \
+            or time.time() - authorization[2] > app.config['AUDIO_AUTHORIZATION_CACHE_SECONDS'] \
+            or audio_file_dict['p_id'] != authorization[0] \
+            or audio_file_dict['g_id'] not in authorization[1]:
+        authorization = (session['participant_id'], frozenset(session['condition_group_ids']), time.time())
+        if sid is not None:
+            _audio_authorizations.put(sid, authorization)
+
+    assert (audio_file_dict['p_id'] == authorization[0])
+    assert (audio_file_dict['g_id'] in authorization[1])
+
+
 @app.route('/audio/<audio_file_key>.wav')
 def audio(audio_file_key):
     """
@@ -255,23 +606,125 @@ def audio(audio_file_key):
 
     if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
         try:
-            audio_file_dict = utilities.decrypt_data(str(audio_file_key))
+            audio_file_dict = experiment.resolve_audio_url_token(audio_file_key)
 
             # can also assert that this file is for this specific participant and condition
-            assert (audio_file_dict['p_id'] == session['participant_id'])
-            assert (audio_file_dict['g_id'] in session['condition_group_ids'])
+            authorize_audio(audio_file_dict)
             filename = audio_file_dict['URL']
         except (ValueError, TypeError):
             filename = audio_file_key + file_format
     else:
         filename = audio_file_key + file_format
 
+    if app.config['AUDIO_REDIRECT_ENABLED']:
+        url, expires = signed_audio_url(filename)
+        response = redirect(url)
+        response.cache_control.private = True
+        response.cache_control.max_age = max(int(expires - time.time()) - app.config['AUDIO_REDIRECT_TTL'], 0)
+        return response
+
+    response = send_stimulus_file(filename)
+
+    # a participant's stimulus URLs don't change between page loads (see `RANDOMIZATION_SALT`), so let the browser
+    # keep the audio
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['AUDIO_CACHE_MAX_AGE']
+    return response
+
+
+def send_stimulus_file(filename):
+    """
+    Send an audio stimulus, from the `AUDIO_FILE_DIRECTORY` or the external file host.
+
+    Parameters
+    ----------
+    filename : str
+        Path relative to the `AUDIO_FILE_DIRECTORY`
+
+    Returns
+    -------
+    flask.Response
+    """
     if app.config['EXTERNAL_FILE_HOST']:
-        # return send_file_partial(app.config['AUDIO_FILE_DIRECTORY']+filename)
-        return send_file_partial_hack(safe_join(app.config['AUDIO_FILE_DIRECTORY'], filename))
+        url = safe_join(app.config['AUDIO_FILE_DIRECTORY'], filename)
+        path = cache_external_file(url) if app.config['EXTERNAL_FILE_CACHE_ENABLED'] else None
+        if path is not None:
+            return send_audio_file(path)
+        return send_external_file_partial(url)
+    return send_audio_file(safe_join(safe_join(app.root_path, app.config['AUDIO_FILE_DIRECTORY']), filename))
 
-    else:
-        return send_file_partial(safe_join(safe_join(app.root_path, app.config['AUDIO_FILE_DIRECTORY']), filename))
+
+def signed_audio_url(filename):
+    """
+    Make the short-lived signed URL of an audio stimulus (see `AUDIO_REDIRECT_ENABLED`). With
+    `ENCRYPT_AUDIO_STIMULI_URLS`, the URL names the file by its alias (see `caqe.utilities.audio_file_alias`).
+
+    Parameters
+    ----------
+    filename : str
+        Path relative to the `AUDIO_FILE_DIRECTORY`
+
+    Returns
+    -------
+    url : str
+    expires : int
+        Unix time after which the URL is invalid
+    """
+    if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
+        # don't reveal the stimulus in the redirect
+        filename = utilities.audio_file_alias(filename, app.config['AUDIO_REDIRECT_SECRET_KEY'])
+
+    ttl = app.config['AUDIO_REDIRECT_TTL']
+    # round the expiry time up, so that the URL is the same for a while and can be cached
+    expires = (int(time.time()) // ttl + 2) * ttl
+    base_url = app.config['AUDIO_REDIRECT_URL'] or url_for('signed_audio', filename='', _external=True,
+                                                           _scheme=app.config['PREFERRED_URL_SCHEME'])
+    # the unquoted path is signed
+    path = urlparse.unquote(urlparse.urlsplit(base_url).path).rstrip('/') + '/' + filename.lstrip('/')
+    signature = utilities.sign_url_path(path, expires, app.config['AUDIO_REDIRECT_SECRET_KEY'])
+    url = urlparse.urljoin(base_url, urlparse.quote(path)) + '?' + \
+        urlparse.urlencode({'expires': expires, 'signature': signature})
+    return url, expires
+
+
+@app.route('/signed_audio/', defaults={'filename': ''})
+@app.route('/signed_audio/<path:filename>')
+def signed_audio(filename):
+    """
+    Verify a signed audio URL made by `signed_audio_url`, and send the audio. Stands in for a static file server when
+    `AUDIO_REDIRECT_URL` is None.
+
+    Parameters
+    ----------
+    filename : str
+        The alias of the file, or with `ENCRYPT_AUDIO_STIMULI_URLS` disabled, its path relative to the
+        `AUDIO_FILE_DIRECTORY`
+
+    Returns
+    -------
+    flask.Response
+    """
+    try:
+        expires = int(request.args['expires'])
+        signature = request.args['signature']
+    except (KeyError, ValueError):
+        abort(403)
+
+    if not utilities.verify_url_path_signature(request.script_root + request.path, expires, signature, time.time(),
+                                               app.config['AUDIO_REDIRECT_SECRET_KEY']):
+        abort(403)
+
+    if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
+        filename = experiment.get_audio_file_aliases().get(filename)
+        if filename is None:
+            abort(404)
+
+    response = send_stimulus_file(filename)
+    # the URL is the same for every participant, so shared caches may keep the audio until it expires
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(expires - time.time()), 0)
+    return response
 
 
 @app.route('/anonymous')
@@ -363,8 +816,7 @@ def begin(platform, crowd_worker_id):
                                                      'target="_blank">Chrome</a>.')
 
     # check conditions if conditions available for anyone
-    conditions = experiment.get_available_conditions()
-    if conditions.count() == 0:
+    if experiment.get_remaining_capacity() == 0:
         return render_template('sorry.html', message='We\'re sorry, but there are no more tasks available.')
 
     # render preview if True
@@ -469,11 +921,12 @@ def pre_evaluation_tasks():
     participant = get_current_participant(session)
 
     # assign conditions
-    session['condition_ids'], session['condition_group_ids'] = experiment.assign_conditions(participant)
+    assignment = experiment.assign_conditions(participant)
 
     # Are there any conditions left for the participant to do?
-    if session['condition_ids'] is None or len(session['condition_ids']) == 0:
+    if assignment is None or len(assignment[0]) == 0:
         return render_template('sorry.html', message='We\'re sorry, but there are no more tasks available for you.')
+    session['condition_ids'], session['condition_group_ids'] = assignment
 
     if app.config['OBTAIN_CONSENT'] and not participant.gave_consent:
         return redirect(url_for('consent', _external=True, scheme=app.config['PREFERRED_URL_SCHEME']))
@@ -614,8 +1067,60 @@ def hearing_test():
             return redirect(url_for('hearing_test', _method='GET', _external=True, _scheme=app.config['PREFERRED_URL_SCHEME']))
 
 
+# directory of the hearing test audio files, relative to the working directory
+HEARING_TEST_AUDIO_DIRECTORY = 'hearing_test_audio'
+
+_hearing_test_audio = None
+_hearing_test_audio_lock = threading.Lock()
+
+
+def load_hearing_test_audio(directory):
+    """
+    Read the hearing test audio files into memory.
+
+    Parameters
+    ----------
+    directory : str
+
+    Returns
+    -------
+    dict
+        Map from file name to (data, ETag, last modified time)
+    """
+    hearing_test_audio = {}
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if not filename.endswith('.wav') or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        hearing_test_audio[filename] = (data,
+                                        hashlib.md5(data).hexdigest(),
+                                        datetime.datetime.utcfromtimestamp(int(os.path.getmtime(path))))
+    return hearing_test_audio
+
+
+def get_hearing_test_audio(filename):
+    """
+    Get a hearing test audio file from memory. The files are read once per process, on first use.
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    tuple
+        (data, ETag, last modified time), or None if there is no such file
+    """
+    global _hearing_test_audio
+    with _hearing_test_audio_lock:
+        if _hearing_test_audio is None:
+            _hearing_test_audio = load_hearing_test_audio(HEARING_TEST_AUDIO_DIRECTORY)
+    return _hearing_test_audio.get(filename)
+
+
 @app.route('/hearing_test/audio/<example_num>.wav')
-@nocache
 def hearing_test_audio(example_num):
     """
     Retrieve audio for hearing test
@@ -632,20 +1137,33 @@ def hearing_test_audio(example_num):
     if example_num == '0':
         # calibration
         if app.config['TEST_TYPE'] == 'segmentation':
-            file_path = 'hearing_test_audio/seg_hearing.wav'
+            filename = 'seg_hearing.wav'
         else:
-            file_path = 'hearing_test_audio/1000Hz.wav'
+            filename = '1000Hz.wav'
     else:
         hearing_test_audio_index = int(utilities.decrypt_data(session['hearing_test_audio_index%s' % example_num]))
         num_tones = hearing_test_audio_index / configuration.HEARING_TEST_AUDIO_FILES_PER_TONES
         file_num = hearing_test_audio_index % configuration.HEARING_TEST_AUDIO_FILES_PER_TONES
         logger.info('hearing_test %s - %d %d' % (example_num, num_tones, file_num))
-        file_path = 'hearing_test_audio/tones%d_%d.wav' % (num_tones, file_num)
-    with open(file_path, 'rb') as f:
-        response = make_response(f.read())
-        response.headers['Content-Type'] = 'audio/wav'
-        response.headers['Accept-Ranges'] = 'bytes'
-    return response
+        filename = 'tones%d_%d.wav' % (num_tones, file_num)
+
+    if app.config['AUDIO_OFFLOAD'] is not None:
+        response = send_audio_file(os.path.join(HEARING_TEST_AUDIO_DIRECTORY, filename))
+    else:
+        audio_file = get_hearing_test_audio(filename)
+        if audio_file is None:
+            abort(404)
+        data, etag, last_modified = audio_file
+        response = send_partial(len(data), 'audio/wav', etag, last_modified,
+                                lambda start, stop: [data[start:stop]])
+
+    if example_num == '0':
+        # the calibration file is the same for everyone
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['AUDIO_CACHE_MAX_AGE']
+        return response
+    # the tones behind the other URLs change with every hearing test
+    return set_nocache_headers(response)
 
 
 @app.route('/evaluation', methods=['GET', 'POST'])
@@ -671,13 +1189,14 @@ def evaluation():
             assert (participant.id == participant_id)
 
             condition_data = json.loads(request.values['completedConditionData'])
+            trials = []
             for cd in condition_data:
                 # get data
                 condition_id = int(cd['conditionID'])
 
                 # decrypt audio stimuli
                 if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
-                    cd = experiment.decrypt_audio_stimuli(cd)
+                    cd = experiment.decrypt_audio_stimuli(cd, participant_id)
 
                 # create database object
                 trial = Trial(participant_id,
@@ -686,14 +1205,22 @@ def evaluation():
                               json.dumps(crowd_data),
                               participant.passed_hearing_test)
                 db.session.add(trial)
+                trials.append(trial)
                 logger.info('Results saved for %r' % trial)
 
+            experiment.record_trials(trials)
             db.session.commit()
+            experiment.invalidate_remaining_capacity()
             session['state'] = 'POST_EVALUATION'
             return json.dumps({'error': False, 'message': 'Data is saved!', 'trial_id': utilities.sign_data(trial.id)})
         except Exception as e:
+            db.session.rollback()
             logger.warning('Error saving results. - %r' % e)
             return json.dumps({'error': True, 'message': 'Error saving data. Error %r' % utilities.sign_data(str(e))})
+    elif app.config['EVALUATION_CONFIG_API_ENABLED'] and app.config['TEST_TYPE'] in EVALUATION_SHELL_TEST_TYPES:
+        return redirect(url_for('evaluation_shell',
+                                test_type=app.config['TEST_TYPE'],
+                                test_id=experiment.get_condition_test_id(session['condition_ids'][0])))
     else:
         test_configurations = experiment.get_test_configurations(session['condition_ids'], participant.id)
 
@@ -758,6 +1285,90 @@ def evaluation():
                                                           _scheme=app.config['PREFERRED_URL_SCHEME']))
 
 
+
+EVALUATION_SHELL_TEST_TYPES = ('mushra', 'pairwise', 'segmentation')
+
+# rendered page shells and their ETags, keyed by test type, test id and design version
+_evaluation_shells = LRUCache(64)
+
+
+@app.route('/evaluation/<test_type>/<int:test_id>', methods=['GET'])
+def evaluation_shell(test_type, test_id):
+    """
+    Renders the listening test page without any participant-specific data (see `EVALUATION_CONFIG_API_ENABLED`). The
+    page loads that from '/evaluation/config'.
+
+    Parameters
+    ----------
+    test_type : str
+    test_id : int
+
+    Returns
+    -------
+    flask.Response
+    """
+    if test_type != app.config['TEST_TYPE'] or test_type not in EVALUATION_SHELL_TEST_TYPES:
+        abort(404)
+
+    key = (test_type, test_id, experiment.get_design_version())
+    shell = _evaluation_shells.get(key)
+    if shell is None:
+        test = experiment.get_cached_test_data(test_id)
+        if test is None:
+            abort(404)
+        html = render_template('%s.html' % test_type,
+                               test=test,
+                               condition_groups={},
+                               conditions=[],
+                               evaluation_config_url=url_for('evaluation_config'))
+        shell = (html, hashlib.md5(html.encode('utf-8')).hexdigest())
+        _evaluation_shells.put(key, shell)
+
+    # the shell of a test only changes when the design is reloaded, so browsers may keep it as long as they revalidate
+    response = make_response(shell[0])
+    response.set_etag(shell[1])
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/evaluation/config', methods=['GET'])
+@nocache
+def evaluation_config():
+    """
+    Returns the participant's conditions and stimuli for the listening test page shell, as JSON.
+
+    Returns
+    -------
+    flask.Response
+    """
+    participant = get_current_participant(session)
+    test_configurations = experiment.get_test_configurations(session['condition_ids'], participant.id)
+
+    # for now don't consider the case that there could be more than one test per participant
+    assert len(test_configurations) == 1, "`test_configuration` has length greater than 1. This is not supported for now."
+    test_config = test_configurations[0]
+
+    data = {'participantID': participant.id,
+            'firstEvaluation': participant.trials.count() == 0,
+            'testCompleteRedirectURL': url_for('post_evaluation_tasks',
+                                               _external=True,
+                                               _scheme=app.config['PREFERRED_URL_SCHEME']),
+            'submissionURL': url_for('evaluation',
+                                     _external=True,
+                                     _scheme=app.config['PREFERRED_URL_SCHEME']),
+            'conditionGroups': dict((group_id, {'referenceFiles': group_data['reference_files'],
+                                                'stimulusFiles': group_data['stimulus_files']})
+                                    for group_id, group_data in test_config['condition_groups'].items()),
+            'conditions': [{'conditionID': condition['id'],
+                            'groupID': condition['group_id'],
+                            'referenceKeys': condition['reference_keys'],
+                            'stimulusKeys': condition['stimulus_keys'],
+                            'evaluation_instructions_html': condition.get('evaluation_instructions_html')}
+                           for condition in test_config['conditions']]}
+    return Response(json.dumps(data), mimetype='application/json')
+
+
 @app.route('/post_evaluation_tasks')
 @nocache
 def post_evaluation_tasks():
@@ -918,16 +1529,13 @@ def mturk_debug():
 @app.route('/admin/stats')
 @nocache
 def admin_stats():
-    trials = Trial.query.all()
     conditions = Condition.query.all()
     passed_hearing_condition_count = dict([(cond.id, 0) for cond in conditions])
     failed_hearing_condition_count = dict([(cond.id, 0) for cond in conditions])
 
-    for trial in trials:
-        if trial.participant_passed_hearing_test:
-            passed_hearing_condition_count[trial.condition_id] += 1
-        else:
-            failed_hearing_condition_count[trial.condition_id] += 1
+    for condition_count in ConditionCount.query.all():
+        passed_hearing_condition_count[condition_count.condition_id] = condition_count.passed_count
+        failed_hearing_condition_count[condition_count.condition_id] = condition_count.failed_count
 
     fieldnames = ['Condition', 'Completed Trials (passed hearing test)', 'Completed Trials (failed hearing test)']
     ids = sorted(passed_hearing_condition_count.keys())
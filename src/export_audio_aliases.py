@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copy the audio files of the design into a directory under their aliases (see `caqe.utilities.audio_file_alias`), to
+upload to the static file server or CDN of signed audio redirects (see `AUDIO_REDIRECT_ENABLED`). Run it after
+``create_db.py``, and again whenever the design, `SECRET_KEY` or `AUDIO_REDIRECT_SECRET_KEY` changes.
+
+To run: ::
+
+    $ python export_audio_aliases.py <output_directory>
+
+"""
+import os
+import shutil
+import sys
+
+from flask import safe_join
+
+import caqe
+import caqe.experiment as experiment
+from caqe.views import cache_external_file
+
+output_directory = sys.argv[1]
+if not os.path.isdir(output_directory):
+    os.makedirs(output_directory)
+
+with caqe.app.app_context():
+    aliases = experiment.get_audio_file_aliases()
+
+for alias, filename in sorted(aliases.items()):
+    if caqe.app.config['EXTERNAL_FILE_HOST']:
+        path = cache_external_file(safe_join(caqe.app.config['AUDIO_FILE_DIRECTORY'], filename))
+    else:
+        path = safe_join(os.path.join(caqe.app.root_path, caqe.app.config['AUDIO_FILE_DIRECTORY']), filename)
+    if path is None or not os.path.isfile(path):
+        print('Missing %s' % filename)
+        continue
+    shutil.copyfile(path, os.path.join(output_directory, alias))
+    print('%s -> %s' % (filename, alias))
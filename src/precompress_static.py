@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write gzip (and, if the `brotli` package is installed, brotli) compressed versions of the static files (e.g. caqe.js,
+jQuery and Bootstrap) next to them, so that they are served without compressing them on each request (see
+`PRECOMPRESSED_STATIC_ENABLED`). The audio directory is skipped. Run this again after changing a static file--stale
+compressed versions are ignored.
+
+To run: ::
+
+    $ python precompress_static.py
+
+"""
+import os
+
+import caqe
+from caqe.compression import precompress_static_files
+
+audio_directory = os.path.relpath(os.path.join(caqe.app.root_path, caqe.app.config['AUDIO_FILE_DIRECTORY']),
+                                  caqe.app.static_folder)
+written = precompress_static_files(caqe.app.static_folder,
+                                   caqe.app.config['COMPRESSION_MIN_SIZE'],
+                                   excluded_directories=[audio_directory])
+for path in written:
+    print(path)
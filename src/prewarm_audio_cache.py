@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Download the reference and stimulus files of the conditions in `TESTS` from the external file host into the local
+external file cache, so that no participant waits on the first download (see `EXTERNAL_FILE_CACHE_ENABLED`). Run it on
+each host, as every host has its own cache.
+
+To run: ::
+
+    $ python prewarm_audio_cache.py
+
+"""
+from flask import safe_join
+
+import caqe
+from caqe.views import cache_external_file
+
+if not caqe.app.config['EXTERNAL_FILE_HOST'] or not caqe.app.config['EXTERNAL_FILE_CACHE_ENABLED']:
+    raise SystemExit('The external file host and its cache must be enabled (see EXTERNAL_FILE_HOST and '
+                     'EXTERNAL_FILE_CACHE_ENABLED).')
+
+filenames = set()
+for test in caqe.app.config['TESTS']:
+    for condition_group in test['condition_groups']:
+        for _, filename in condition_group['reference_files'] + condition_group['stimulus_files']:
+            filenames.add(filename)
+
+failed = 0
+for filename in sorted(filenames):
+    url = safe_join(caqe.app.config['AUDIO_FILE_DIRECTORY'], filename)
+    path = cache_external_file(url)
+    if path is None:
+        failed += 1
+    print('%s -> %s' % (url, path))
+
+print('Cached %d of %d files.' % (len(filenames) - failed, len(filenames)))
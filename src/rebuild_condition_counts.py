@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Recompute the per-condition trial counts (see :class:`caqe.models.ConditionCount`) and the remaining trial slots (see
+:class:`caqe.models.ConditionTicket`) from the saved trials. Run this if trials were inserted or deleted outside of the
+application, or after upgrading CAQE, as it first upgrades the database schema (see
+:func:`caqe.models.upgrade_schema`): the new tables are created and the new columns of existing tables are added. Note
+that any outstanding slot claims are discarded.
+
+To run: ::
+
+    $ python rebuild_condition_counts.py
+
+"""
+
+import caqe
+import caqe.experiment as experiment
+from caqe.models import upgrade_schema
+with caqe.app.app_context():
+    for column in upgrade_schema():
+        print('Added column %s' % column)
+    experiment.rebuild_condition_counts()
+    experiment.rebuild_condition_tickets()
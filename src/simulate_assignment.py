@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load simulator for condition assignment. It creates a synthetic experiment with
+:func:`caqe.experiment.insert_tests_and_conditions` and then simulates participants arriving concurrently, each of
+which is assigned conditions with :func:`caqe.experiment.assign_conditions` and (unless they abandon the task) submits
+trials of them with simulated MUSHRA-style ratings (each condition has its own rating noise), in shuffled order like
+the evaluation page. At the end it reports the outcomes (including submissions that failed, e.g. by deadlocking with a
+concurrent submission), the assignment latency percentiles, the number of database queries per assignment, the
+over-collection per condition and the time until every condition had `TRIALS_PER_CONDITION` trials (or was stopped
+early).
+
+With ``--compare-engines``, the simulation is run one participant at a time with each `CONDITION_ASSIGNMENT_ENGINE`,
+on the same experiment and with the same random seed, and the assignments of the two engines are compared. They should
+be identical; the script exits with an error if they are not.
+
+.. warning:: The database given with ``--database`` is dropped and recreated. Never point this at a database holding
+ real results.
+
+To run, e.g.: ::
+
+    $ python simulate_assignment.py --participants 2000 --concurrency 16
+    $ python simulate_assignment.py --database postgresql://localhost/caqe_sim --engine ticket
+    $ python simulate_assignment.py --compare-engines --randomize-groups
+
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def synthetic_tests(num_groups, conditions_per_group, stimuli_per_group):
+    """
+    Build a `TESTS` configuration of a single pairwise-style test.
+
+    Parameters
+    ----------
+    num_groups : int
+    conditions_per_group : int
+    stimuli_per_group : int
+
+    Returns
+    -------
+    tests : list of dict
+        See `caqe.configuration.BaseConfig.TESTS`
+    """
+    stimulus_keys = ['S%d' % (i + 1) for i in range(stimuli_per_group)]
+    test = {'test_config_variables': {'test_title': 'Simulated test',
+                                      'references': (('Reference', 'The reference signal.'),)},
+            'condition_groups': []}
+    for g in range(num_groups):
+        group_data = {'reference_files': [['Reference', 'sim%04d_ref.wav' % g]],
+                      'stimulus_files': [[k, 'sim%04d_%s.wav' % (g, k)] for k in stimulus_keys],
+                      'conditions': []}
+        for c in range(conditions_per_group):
+            group_data['conditions'].append({'reference_keys': ['Reference'],
+                                             'stimulus_keys': random.sample(stimulus_keys, 2),
+                                             'evaluation_instructions_html': None})
+        test['condition_groups'].append(group_data)
+    return [test]
+
+
+def percentile(values, q):
+    """
+    The `q`-th percentile (0-100) of `values` by the nearest-rank method.
+    """
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    rank = max(int(round(q / 100. * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def simulate(args):
+    """
+    Run the simulation described by the command-line `args` and print a report.
+
+    Returns
+    -------
+    assignments : dict
+        Map from (participant number, evaluation number) to the assignment returned by
+        :func:`caqe.experiment.assign_conditions`
+    """
+    from sqlalchemy import event
+
+    from caqe import app, db
+    import caqe.experiment as experiment
+    from caqe.models import Condition, ConditionCount, Participant, Trial
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['TRIALS_PER_CONDITION'] = args.trials_per_condition
+    app.config['CONDITIONS_PER_EVALUATION'] = args.conditions_per_evaluation
+    app.config['CONDITION_ASSIGNMENT_ENGINE'] = args.engine
+    app.config['CONDITION_RESERVATION_TTL_SECONDS'] = args.reservation_ttl
+    app.config['TEST_CONDITION_GROUP_ORDER_RANDOMIZED'] = args.randomize_groups
+    app.config['CONDITION_ALLOCATION_POLICY'] = args.allocation_policy
+    app.config['EARLY_STOPPING_ENABLED'] = args.early_stopping
+    app.config['EARLY_STOPPING_MAX_CI_HALF_WIDTH'] = args.early_stopping_ci
+    app.config['TEST_TYPE'] = 'mushra'
+    app.config['IP_COLLECTION_ENABLED'] = False
+
+    config = dict(app.config)
+    config['TESTS'] = synthetic_tests(args.groups, args.conditions_per_group, args.stimuli_per_group)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        setup_start = time.time()
+        experiment.insert_tests_and_conditions(config)
+        print('Inserted %d groups of %d conditions in %.1f s' % (args.groups,
+                                                                 args.conditions_per_group,
+                                                                 time.time() - setup_start))
+
+        # the true mean rating of each stimulus and the rating noise of each condition
+        rating_means = {}
+        rating_noise = {}
+        for condition_id, data in db.session.query(Condition.id, Condition.data):
+            rating_means[condition_id] = dict((k, random.uniform(0, 100))
+                                              for k in json.loads(data)['stimulus_keys'])
+            rating_noise[condition_id] = random.uniform(args.min_rating_noise, args.max_rating_noise)
+
+        # count the queries issued by each thread
+        query_counts = threading.local()
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            query_counts.n = getattr(query_counts, 'n', 0) + 1
+
+    lock = threading.Lock()
+    latencies = []
+    queries = []
+    outcomes = defaultdict(int)
+    assignments = {}
+
+    def run_participant(participant_num):
+        with app.app_context():
+            participant = Participant('simulation', crowd_worker_id='SIM%08d' % participant_num)
+            participant.passed_hearing_test = random.random() < args.pass_rate
+            db.session.add(participant)
+            db.session.commit()
+
+            for hit_num in range(args.hits_per_participant):
+                query_counts.n = 0
+                assignment_start = time.time()
+                assignment = experiment.assign_conditions(participant)
+                elapsed = time.time() - assignment_start
+                with lock:
+                    latencies.append(elapsed)
+                    queries.append(query_counts.n)
+                    assignments[(participant_num, hit_num)] = assignment
+
+                if assignment is None:
+                    with lock:
+                        outcomes['no conditions'] += 1
+                    break
+                if random.random() < args.abandon_rate:
+                    with lock:
+                        outcomes['abandoned'] += 1
+                    break
+
+                time.sleep(random.uniform(0, args.max_think_time))
+                # the evaluation page submits the conditions in its own shuffled order
+                condition_ids = random.sample(assignment[0], len(assignment[0]))
+                trials = []
+                for condition_id in condition_ids:
+                    trial = Trial(participant.id,
+                                  condition_id,
+                                  json.dumps({'ratings': dict((k, random.gauss(mean, rating_noise[condition_id]))
+                                                              for k, mean in rating_means[condition_id].items())}),
+                                  None,
+                                  participant.passed_hearing_test)
+                    db.session.add(trial)
+                    trials.append(trial)
+                try:
+                    experiment.record_trials(trials)
+                    db.session.commit()
+                except Exception:
+                    # e.g. a deadlock between concurrent submissions, which the evaluation view reports as an error
+                    db.session.rollback()
+                    with lock:
+                        outcomes['failed submissions'] += 1
+                    break
+                experiment.invalidate_remaining_capacity()
+                with lock:
+                    outcomes['submitted'] += 1
+            db.session.remove()
+
+    run_start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for result in executor.map(run_participant, range(args.participants)):
+            pass
+    run_time = time.time() - run_start
+
+    with app.app_context():
+        passed_trials = defaultdict(list)
+        for condition_id, completed in db.session.query(Trial.condition_id, Trial.datetime_completed). \
+                filter(Trial.participant_passed_hearing_test == True).order_by(Trial.datetime_completed):
+            passed_trials[condition_id].append(completed)
+        finished = set(c for c, in db.session.query(ConditionCount.condition_id).
+                       filter(ConditionCount.finished == True))
+        num_conditions = args.groups * args.conditions_per_group
+        over_collection = [max(len(passed_trials[c]) - args.trials_per_condition, 0)
+                           for c in range(1, num_conditions + 1)]
+        needed_trials = dict((c, len(passed_trials[c]) if c in finished else args.trials_per_condition)
+                             for c in range(1, num_conditions + 1))
+        incomplete = [c for c in range(1, num_conditions + 1) if len(passed_trials[c]) < needed_trials[c]]
+        if len(incomplete) == 0:
+            completion_time = max(passed_trials[c][needed_trials[c] - 1]
+                                  for c in range(1, num_conditions + 1) if needed_trials[c] > 0)
+        first_trial = db.session.query(Trial.datetime_completed).order_by(Trial.datetime_completed).first()
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    print('Simulated %d participants with %d threads in %.1f s (%s)' %
+          (args.participants, args.concurrency, run_time,
+           ', '.join('%s: %d' % (k, v) for k, v in sorted(outcomes.items()))))
+    print('Assignment latency (ms): p50=%.1f p95=%.1f p99=%.1f max=%.1f' %
+          tuple(1000. * x for x in (percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+                                    max(latencies))))
+    print('Queries per assignment: mean=%.1f max=%d' % (float(sum(queries)) / len(queries), max(queries)))
+    print('Over-collection: %d extra trials in total, max %d per condition, %d of %d conditions over' %
+          (sum(over_collection), max(over_collection), len([x for x in over_collection if x > 0]), num_conditions))
+    if args.early_stopping:
+        print('Early stopping: %d of %d conditions stopped, %d passed trials in total' %
+              (len(finished), num_conditions, sum(len(v) for v in passed_trials.values())))
+    if len(incomplete) == 0:
+        print('Time to completion: %.1f s after the first trial' %
+              (completion_time - first_trial[0]).total_seconds())
+    else:
+        print('Time to completion: incomplete, %d of %d conditions are short of trials' % (len(incomplete),
+                                                                                            num_conditions))
+    return assignments
+
+
+def compare_engines(args):
+    """
+    Run the simulation with each `CONDITION_ASSIGNMENT_ENGINE` and compare the assignments.
+
+    Returns
+    -------
+    bool
+        True if the engines assigned the same conditions to every participant
+    """
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
+    # assignments only depend on the random seed if the participants take turns
+    args.concurrency = 1
+
+    assignments = {}
+    for engine in ('query', 'ticket'):
+        print('Engine: %s' % engine)
+        args.engine = engine
+        random.seed(args.seed)
+        assignments[engine] = simulate(args)
+
+    differences = sorted(k for k in assignments['query'] if assignments['query'][k] != assignments['ticket'].get(k))
+    for participant_num, hit_num in differences[:10]:
+        print('Participant %d, evaluation %d: query assigned %r, ticket assigned %r' %
+              (participant_num, hit_num, assignments['query'][(participant_num, hit_num)],
+               assignments['ticket'].get((participant_num, hit_num))))
+    print('The engines made %d different assignments of %d (seed %d)' % (len(differences),
+                                                                         len(assignments['query']),
+                                                                         args.seed))
+    return len(differences) == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent participants to benchmark condition assignment.')
+    parser.add_argument('--database', default=None,
+                        help='Database URI to (re)create the experiment in. (default is a temporary SQLite file)')
+    parser.add_argument('--participants', type=int, default=1000, help='Number of participants. (default is 1000)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent participants. (default is 8)')
+    parser.add_argument('--hits-per-participant', type=int, default=1,
+                        help='Number of evaluations each participant attempts. (default is 1)')
+    parser.add_argument('--groups', type=int, default=50, help='Number of condition groups. (default is 50)')
+    parser.add_argument('--conditions-per-group', type=int, default=4,
+                        help='Number of conditions per group. (default is 4)')
+    parser.add_argument('--stimuli-per-group', type=int, default=8,
+                        help='Number of stimuli per group. (default is 8)')
+    parser.add_argument('--trials-per-condition', type=int, default=20,
+                        help='TRIALS_PER_CONDITION. (default is 20)')
+    parser.add_argument('--conditions-per-evaluation', type=int, default=2,
+                        help='CONDITIONS_PER_EVALUATION. (default is 2)')
+    parser.add_argument('--engine', choices=['query', 'ticket'], default='query',
+                        help='CONDITION_ASSIGNMENT_ENGINE. (default is query)')
+    parser.add_argument('--reservation-ttl', type=int, default=60,
+                        help='CONDITION_RESERVATION_TTL_SECONDS. (default is 60)')
+    parser.add_argument('--randomize-groups', action='store_true', help='TEST_CONDITION_GROUP_ORDER_RANDOMIZED.')
+    parser.add_argument('--allocation-policy', choices=['fixed', 'variance'], default='fixed',
+                        help='CONDITION_ALLOCATION_POLICY. (default is fixed)')
+    parser.add_argument('--early-stopping', action='store_true', help='EARLY_STOPPING_ENABLED.')
+    parser.add_argument('--early-stopping-ci', type=float, default=5.,
+                        help='EARLY_STOPPING_MAX_CI_HALF_WIDTH. (default is 5)')
+    parser.add_argument('--min-rating-noise', type=float, default=2.,
+                        help='Minimum standard deviation of the ratings of a condition. (default is 2)')
+    parser.add_argument('--max-rating-noise', type=float, default=20.,
+                        help='Maximum standard deviation of the ratings of a condition. (default is 20)')
+    parser.add_argument('--pass-rate', type=float, default=0.9,
+                        help='Fraction of participants that passed the hearing test. (default is 0.9)')
+    parser.add_argument('--abandon-rate', type=float, default=0.1,
+                        help='Fraction of assignments that are never submitted. (default is 0.1)')
+    parser.add_argument('--max-think-time', type=float, default=0.,
+                        help='Maximum seconds between assignment and submission. (default is 0)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed.')
+    parser.add_argument('--compare-engines', action='store_true',
+                        help='Run with each CONDITION_ASSIGNMENT_ENGINE and compare the assignments.')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.database is None:
+        args.database = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'caqe_simulation.db')
+
+    if args.compare_engines:
+        sys.exit(0 if compare_engines(args) else 1)
+    else:
+        simulate(args)